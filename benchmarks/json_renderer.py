@@ -0,0 +1,77 @@
+"""Benchmark the 'json' and 'json_stream' renderers on search results
+
+Encodes a search result of synthetic 'fs.files' metadata with both
+renderers, reporting time and peak memory (where tracemalloc is
+available) for each.  Run as::
+
+    python benchmarks/json_renderer.py [documents]
+
+"""
+from datetime import datetime, timedelta
+import sys
+import time
+
+from bson.objectid import ObjectId
+from pyramid import testing
+
+from pheme.webAPI.renderers import json_renderer, streaming_json_renderer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def metadata(count):
+    """Generate count documents shaped like search results"""
+    now = datetime.utcnow()
+    for i in range(count):
+        yield {'_id': ObjectId(), 'filename': 'essence_%06d.txt' % i,
+               'report_type': 'essence', 'patient_class': 'E',
+               'reportable_region': 'wa', 'include_updates': True,
+               'uploadDate': now - timedelta(minutes=i),
+               'start_time': now - timedelta(days=30),
+               'end_time': now, 'length': 1024 + i, 'chunkSize': 262144,
+               'md5': '%032x' % i, 'version': 1, 'latest': True,
+               'content_type': 'text/plain', 'compression': None}
+
+
+def render_json(documents):
+    request = testing.DummyRequest()
+    render = json_renderer(None)
+    return len(render(list(documents), {'request': request}))
+
+
+def render_stream(documents):
+    request = testing.DummyRequest()
+    render = streaming_json_renderer(None)
+    render(documents, {'request': request})
+    return sum(len(block) for block in request.response.app_iter)
+
+
+def measure(name, render, count):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    size = render(metadata(count))
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1] if tracemalloc else None
+    if tracemalloc:
+        tracemalloc.stop()
+    print("%-12s %8d docs %10d bytes %7.3fs %s" % (
+        name, count, size, elapsed,
+        "peak %.1f MB" % (peak / 1048576.0) if peak is not None else ''))
+
+
+def main(count=50000):
+    testing.setUp()
+    try:
+        for name, render in (('json', render_json),
+                             ('json_stream', render_stream)):
+            measure(name, render, count)
+    finally:
+        testing.tearDown()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
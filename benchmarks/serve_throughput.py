@@ -0,0 +1,83 @@
+"""Benchmark request throughput of pheme_serve by number of workers
+
+Starts `pheme_serve` with 1, 2, 4... workers (up to the number of
+cores), and drives a CPU heavy request, such as a compressed document
+or a large search, from as many client processes as there are cores.
+Reports the requests served per second, and the speedup over a single
+worker.  Run against a configured database holding the document::
+
+    python benchmarks/serve_throughput.py development.ini \\
+        /essence_pcE/<document id> --seconds 20
+
+"""
+import argparse
+import multiprocessing
+import socket
+import subprocess
+import time
+
+import requests
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError("server didn't start on port %d" % port)
+
+
+def client(args):
+    """Request url until the deadline, returning the count served"""
+    url, deadline = args
+    session = requests.Session()
+    served = 0
+    while time.time() < deadline:
+        if session.get(url).status_code == 200:
+            served += 1
+    return served
+
+
+def measure(config_uri, path, workers, clients, seconds, port):
+    server = subprocess.Popen(['pheme_serve', config_uri,
+                               '--workers', str(workers),
+                               '--host', '127.0.0.1', '--port', str(port)])
+    try:
+        wait_for(port)
+        url = 'http://127.0.0.1:%d%s' % (port, path)
+        client((url, time.time() + 2))  # warm up
+        pool = multiprocessing.Pool(clients)
+        deadline = time.time() + seconds
+        served = sum(pool.map(client, [(url, deadline)] * clients))
+        pool.close()
+        return served / float(seconds)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config_uri', help="initialization file")
+    parser.add_argument('path', help="path of the request to drive")
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--port', type=int, default=6580)
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    counts = sorted(set([1] + [2 ** i for i in range(1, 8)
+                               if 2 ** i <= cores] + [cores]))
+    baseline = None
+    for workers in counts:
+        rate = measure(args.config_uri, args.path, workers, cores,
+                       args.seconds, args.port)
+        baseline = baseline or rate
+        print("%3d workers %9.1f requests/s  %5.2fx" % (
+            workers, rate, rate / baseline if baseline else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,30 @@
+import logging
+
+try:
+    from ConfigParser import NoSectionError
+except ImportError:  # python 3
+    from configparser import NoSectionError
+
 from pyramid.config import Configurator
 from pyramid.events import subscriber
 from pyramid.events import NewRequest
-import pymongo
+from pyramid.settings import asbool
 from gridfs import GridFS
 
-from pheme.webAPI.resources import Root
-from pheme.webAPI.renderers import json_renderer
+from pheme.webAPI import packs, report_types
+from pheme.webAPI.admission import AdmissionController
+from pheme.webAPI.cache import ContentCache, SearchCache
+from pheme.webAPI.connection import ForkSafeClient, connect
+from pheme.webAPI.delivery import DeliveryWatcher, phinms_directories
+from pheme.webAPI.events import ConsumerLimit, ensure_event_log
+from pheme.webAPI.memory import MemoryMonitor
+from pheme.webAPI.metrics import MetricsPublisher, WorkerMetrics
+from pheme.webAPI.metrics import ensure_metrics
+from pheme.webAPI.report_types import Buckets
+from pheme.webAPI.resources import ConfiguredReport, Root, ensure_indexes
+from pheme.webAPI.retention import RetentionSweeper, parse_rules
+from pheme.webAPI.routing import ReadRouter, parse_preferences
+from pheme.webAPI.renderers import json_renderer, streaming_json_renderer
 
 @subscriber(NewRequest)
 def add_mongo_db(event):
@@ -21,15 +40,142 @@ def add_mongo_db(event):
     event.request.fs = GridFS(db)
     event.request.document_store = db['fs.files']
 
+    # Report types may be configured to use their own GridFS namespace
+    event.request.buckets = Buckets(db)
+
+    # Optional routing of read only views to replica set secondaries
+    event.request.read_router = settings.get('read_router')
+    event.request.content_cache = settings.get('content_cache')
+    event.request.search_cache = settings.get('search_cache')
+
+def start_worker(settings, primary=True):
+    """Create the per process caches and start background threads
+
+    Called by main() when serving from a single process, otherwise in
+    each worker process once forked.  Caches are never shared between
+    processes.  The threads which must only run once per deployment
+    (PHIN-MS delivery watcher, retention sweeper) are only started in
+    the `primary` worker.
+
+    """
+    # optional in memory cache of frequently fetched document contents
+    max_bytes = int(settings.get('content_cache.max_bytes', 0))
+    if max_bytes:
+        max_item_bytes = int(settings.get('content_cache.max_item_bytes',
+                                          max_bytes // 16))
+        settings['content_cache'] = ContentCache(max_bytes, max_item_bytes)
+
+    # optional cache of search results, invalidated on any write, by
+    # any worker where there are several
+    max_entries = int(settings.get('search_cache.max_entries', 0))
+    if max_entries:
+        settings['search_cache'] = SearchCache(
+            max_entries,
+            int(settings.get('search_cache.max_documents', 1000)),
+            shared=int(settings.get('workers', 1)) > 1)
+
+    if settings.get('memory_monitor') is not None:
+        settings['memory_monitor'].start()
+
+    if settings.get('metrics') is not None:
+        settings['metrics'].reset()
+        MetricsPublisher(settings, float(settings['metrics.interval'])
+                         ).start()
+
+    if not primary:
+        return
+
+    # confirm delivery of files handed off to PHIN-MS
+    if asbool(settings.get('phinms.watch_delivery', False)):
+        try:
+            directories = phinms_directories()
+        except NoSectionError:
+            logging.warning("phinms.watch_delivery set without a [phinms] "
+                            "config section, not watching deliveries")
+        else:
+            DeliveryWatcher(settings, directories,
+                            int(settings.get('phinms.poll_interval', 30))
+                            ).start()
+
+    rules = settings['retention_rules']
+    interval = int(settings.get('retention.sweep_interval', 0))
+    if rules and interval:
+        RetentionSweeper(settings, rules, interval,
+                         int(settings.get('retention.batch_size', 100)),
+                         float(settings.get('retention.batch_pause', 1.0))
+                         ).start()
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     config = Configurator(root_factory=Root, settings=settings)
     config.add_renderer('json', json_renderer)
+    config.add_renderer('json_stream', streaming_json_renderer)
+
+    # report types added or adjusted in configuration
+    report_types.configure(settings, ConfiguredReport)
+
+    # mongodb addition, each (forked) process gets its own client
+    config.registry.settings['db_conn'] = ForkSafeClient(
+        lambda: connect(settings))
+    db = config.registry.settings['db_conn'][settings['db_name']]
+    ensure_indexes(db)
+    ensure_event_log(db, int(settings.get('events.size', 16 * 1024 * 1024)))
+    # change feed consumers each hold a server thread while waiting
+    max_consumers = int(settings.get('changes.max_consumers', 0))
+    if max_consumers:
+        config.registry.settings['change_consumers'] = ConsumerLimit(
+            max_consumers)
+
+    preferences = parse_preferences(settings)
+    if preferences:
+        config.registry.settings['read_router'] = ReadRouter(
+            config.registry.settings['db_conn'], settings['db_name'],
+            preferences,
+            int(settings.get('read_preference.max_staleness', 90)))
+
+    # optional admission control, limiting concurrent large transfers
+    # and the bytes they hold in memory
+    max_in_flight = int(settings.get('admission.max_bytes', 0))
+    if max_in_flight:
+        config.registry.settings['admission'] = AdmissionController(
+            int(settings.get('admission.small_slots', 16)),
+            int(settings.get('admission.large_slots', 2)),
+            max_in_flight,
+            int(settings.get('admission.large_bytes', 1024 * 1024)),
+            float(settings.get('admission.queue_timeout', 5)),
+            int(settings.get('admission.retry_after', 10)))
+        config.add_tween('pheme.webAPI.admission.admission_tween_factory')
+
+    # opt in memory high-water instrumentation of every request
+    if asbool(settings.get('memory.profile', False)):
+        monitor = MemoryMonitor(
+            float(settings.get('memory.interval', 0.05)),
+            int(settings.get('memory.log_threshold', 64 * 1024 * 1024)),
+            int(settings.get('memory.keep', 1000)))
+        config.registry.settings['memory_monitor'] = monitor
+        config.add_tween('pheme.webAPI.memory.memory_tween_factory')
+
+    # cold tier archive of old documents, moved out of GridFS
+    if settings.get('archive.directory'):
+        packs.configure(settings['archive.directory'],
+                        int(settings.get('archive.max_pack_bytes', 1 << 30)))
+
+    # request metrics, published for aggregation across workers
+    if float(settings.get('metrics.interval', 0)):
+        ensure_metrics(db)
+        config.registry.settings['metrics'] = WorkerMetrics()
+        config.add_tween('pheme.webAPI.metrics.metrics_tween_factory')
+
+    # retention rules, enforced by the optional background sweeper
+    config.registry.settings['retention_rules'] =\
+        parse_rules(settings.get('retention.rules'))
 
-    # mongodb addition
-    config.registry.settings['db_conn'] =\
-        pymongo.Connection(settings['db_uri'])
+    # with multiple worker processes, start_worker is called after
+    # each fork instead (see pheme.webAPI.serve)
+    if not asbool(settings.get('prefork', False)):
+        start_worker(config.registry.settings)
 
     config.add_static_view('static', 'pheme.webAPI:static', cache_max_age=3600)
     #config.add_route('home', '/')
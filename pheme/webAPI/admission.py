@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+SMALL, LARGE = 'small', 'large'
+
+
+class Overloaded(HTTPServiceUnavailable):
+    """Raised when a request can't be admitted in time"""
+    def __init__(self, detail, retry_after):
+        super(Overloaded, self).__init__(
+            detail, headers={'Retry-After': str(retry_after)})
+
+
+class AdmissionController(object):
+    """Limit concurrent requests, and bytes in flight, by lane
+
+    Requests are admitted to one of two lanes, each with its own
+    number of slots, so a burst of large uploads or downloads can't
+    starve the small (i.e. metadata or search) requests.  Separately,
+    the bytes held in memory by all admitted requests are kept within
+    `max_bytes`; a single request larger than the whole budget is
+    admitted only when nothing else is in flight.
+
+    Requests which can't be admitted wait up to `queue_timeout`
+    seconds, before being rejected with 503 and a Retry-After of
+    `retry_after` seconds.
+
+    :param small_slots: concurrent requests in the small lane
+    :param large_slots: concurrent requests in the large lane
+    :param max_bytes: budget of request and response bytes in flight
+    :param large_bytes: requests of at least this many bytes use the
+      large lane
+
+    """
+    def __init__(self, small_slots, large_slots, max_bytes, large_bytes,
+                 queue_timeout=5, retry_after=10):
+        self.slots = {SMALL: small_slots, LARGE: large_slots}
+        self.max_bytes = max_bytes
+        self.large_bytes = large_bytes
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = {SMALL: 0, LARGE: 0}
+        self.bytes_in_flight = 0
+        self._condition = threading.Condition()
+
+    def lane(self, nbytes):
+        return LARGE if nbytes >= self.large_bytes else SMALL
+
+    def _wait(self, admissible, what):
+        """Wait, holding the lock, until admissible() or time runs out"""
+        deadline = time.time() + self.queue_timeout
+        while not admissible():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning("admission refused %s: %r", what, self)
+                raise Overloaded("Server busy, %s refused" % what,
+                                 self.retry_after)
+            self._condition.wait(remaining)
+
+    def _fits(self, nbytes):
+        return self.bytes_in_flight + nbytes <= self.max_bytes or\
+            self.bytes_in_flight == 0
+
+    def admit(self, nbytes=0):
+        """Admit a request of nbytes, returning its Ticket"""
+        lane = self.lane(nbytes)
+        with self._condition:
+            self._wait(lambda: self.in_flight[lane] < self.slots[lane] and
+                       self._fits(nbytes), "%s request" % lane)
+            self.in_flight[lane] += 1
+            self.bytes_in_flight += nbytes
+        return Ticket(self, lane, nbytes)
+
+    def charge(self, ticket, nbytes):
+        """Add nbytes to an admitted ticket, moving lanes if need be"""
+        lane = self.lane(ticket.nbytes + nbytes)
+        moving = lane != ticket.lane
+        with self._condition:
+            self._wait(lambda: self._fits(nbytes) and
+                       (not moving or
+                        self.in_flight[lane] < self.slots[lane]),
+                       "%d bytes" % nbytes)
+            if moving:
+                self.in_flight[ticket.lane] -= 1
+                self.in_flight[lane] += 1
+                ticket.lane = lane
+            self.bytes_in_flight += nbytes
+            ticket.nbytes += nbytes
+            self._condition.notify_all()
+
+    def release(self, ticket):
+        with self._condition:
+            self.in_flight[ticket.lane] -= 1
+            self.bytes_in_flight -= ticket.nbytes
+            self._condition.notify_all()
+
+    def __repr__(self):
+        return "<AdmissionController small %d/%d large %d/%d bytes %d/%d>"\
+            % (self.in_flight[SMALL], self.slots[SMALL],
+               self.in_flight[LARGE], self.slots[LARGE],
+               self.bytes_in_flight, self.max_bytes)
+
+
+class Ticket(object):
+    """An admitted request's lane and bytes held"""
+    def __init__(self, controller, lane, nbytes):
+        self.controller = controller
+        self.lane = lane
+        self.nbytes = nbytes
+        self.released = False
+
+    def charge(self, nbytes):
+        """Account for nbytes more held by the request
+
+        Raises Overloaded should the bytes not be admitted in time.
+
+        """
+        self.controller.charge(self, nbytes)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self)
+
+
+def charge(request, nbytes):
+    """Charge nbytes against the request's admission, if enabled"""
+    ticket = getattr(request, 'admission', None)
+    if ticket is not None:
+        ticket.charge(nbytes)
+
+
+def admission_tween_factory(handler, registry):
+    """Tween admitting requests through the configured controller
+
+    Uploads are admitted by their Content-Length.  Downloads start in
+    the small lane, and are charged the size of each document read
+    into memory (see `charge`), moving to the large lane once large.
+
+    The ticket is released once the view returns.  Streamed responses
+    (i.e. exports and the change feed) don't hold their content in
+    memory, and aren't held to the limits while streaming.
+
+    """
+    controller = registry.settings.get('admission')
+    if controller is None:
+        return handler
+
+    def admission_tween(request):
+        try:
+            ticket = controller.admit(request.content_length or 0)
+        except Overloaded as e:
+            return e
+        request.admission = ticket
+        try:
+            return handler(request)
+        finally:
+            ticket.release()
+    return admission_tween
@@ -0,0 +1,95 @@
+import argparse
+from datetime import datetime, timedelta
+import logging
+import time
+
+import pymongo
+from pyramid.paster import get_appsettings, setup_logging
+
+from pheme.webAPI import packs, report_types
+from pheme.webAPI.report_types import Buckets
+from pheme.webAPI.resources import ConfiguredReport, open_stored
+
+
+def archive_document(bucket, document, pack_store):
+    """Move a document's content out of GridFS into the pack store
+
+    The content is appended to the pack store (as reconstructed, were
+    it delta encoded), the '<bucket>.files' document is pointed at the
+    pack record, and only then are the GridFS chunks removed.
+
+    """
+    content = open_stored(bucket.fs, document)
+    pointer = pack_store.append(document['_id'], content)
+    bucket.files.update({'_id': document['_id']},
+                        {'$set': {'archive': pointer},
+                         '$unset': {'storage': 1, 'delta_base': 1,
+                                    'delta_chain': 1}}, w=1)
+    bucket.chunks.remove({'files_id': document['_id']})
+    return pointer
+
+
+def archive_documents(db, pack_store, cutoff, batch_size=100,
+                      batch_pause=1.0):
+    """Archive every document uploaded before cutoff
+
+    Works through the documents batch_size at a time, oldest first via
+    the uploadDate index, pausing batch_pause seconds between batches
+    to limit the load imposed.  Each batch starts from the last one's
+    uploadDate, so documents archived by earlier runs and batches
+    aren't scanned again.
+
+    Returns the count of documents archived.
+
+    """
+    archived = 0
+    for bucket in Buckets(db).all():
+        criteria = {'uploadDate': {'$lt': cutoff},
+                    'archive': {'$exists': False}}
+        while True:
+            batch = list(bucket.files.find(criteria).
+                         sort('uploadDate', pymongo.ASCENDING).
+                         limit(batch_size))
+            if not batch:
+                break
+            for document in batch:
+                archive_document(bucket, document, pack_store)
+            criteria['uploadDate']['$gte'] = batch[-1]['uploadDate']
+            archived += len(batch)
+            logging.info("archived %d documents", archived)
+            time.sleep(batch_pause)
+    return archived
+
+
+def main():
+    """Entry point to archive documents older than a number of days
+
+    Uses the database and archive settings from the named
+    initialization file, i.e.::
+
+        pheme_archive production.ini --days 180
+
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('config_uri', help="initialization file")
+    parser.add_argument('--days', type=int,
+                        help="archive documents older than this, "
+                        "defaults to the archive.after_days setting")
+    args = parser.parse_args()
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    if not settings.get('archive.directory'):
+        parser.error("archive.directory isn't set in %s" % args.config_uri)
+    report_types.configure(settings, ConfiguredReport)
+    days = args.days or int(settings['archive.after_days'])
+    pack_store = packs.configure(
+        settings['archive.directory'],
+        int(settings.get('archive.max_pack_bytes', 1 << 30)))
+    db = pymongo.Connection(settings['db_uri'])[settings['db_name']]
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    count = archive_documents(
+        db, pack_store, cutoff,
+        int(settings.get('archive.batch_size', 100)),
+        float(settings.get('archive.batch_pause', 1.0)))
+    logging.info("archived %d documents uploaded before %s", count, cutoff)
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import json
+import logging
+import threading
+
+
+class ContentCache(object):
+    """Byte budgeted LRU cache of decompressed document contents
+
+    Frequently fetched reports are held in memory to avoid re-reading
+    every chunk from GridFS and expanding the content on each request.
+    Entries are keyed by document id, and only returned when the
+    GridFS md5 of the stored document still matches, so a replaced
+    document is never served stale.
+
+    Documents whose content exceeds `max_item_bytes` are never
+    cached.  When the total cached bytes exceed `max_bytes`, the least
+    recently used entries are evicted.
+
+    """
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, oid, md5):
+        """Return cached content for oid, or None on a miss
+
+        :param oid: the document (Object) ID
+        :param md5: the GridFS md5 of the stored document
+
+        """
+        with self._lock:
+            entry = self._entries.get(oid)
+            if entry is None:
+                return None
+            if entry[0] != md5:
+                # Stored document changed underneath us
+                self._remove(oid)
+                return None
+            # Mark as most recently used
+            del self._entries[oid]
+            self._entries[oid] = entry
+            return entry[1]
+
+    def put(self, oid, md5, content):
+        """Cache content for oid, evicting as needed to stay in budget
+
+        Returns True if the content was cached.
+
+        """
+        size = len(content)
+        if size > self.max_item_bytes or size > self.max_bytes:
+            return False
+        with self._lock:
+            self._remove(oid)
+            while self.total_bytes + size > self.max_bytes:
+                evicted, entry = self._entries.popitem(last=False)
+                self.total_bytes -= len(entry[1])
+                logging.debug("content cache evicted %s", evicted)
+            self._entries[oid] = (md5, content)
+            self.total_bytes += size
+        return True
+
+    def invalidate(self, oid):
+        """Drop any cached content for oid"""
+        with self._lock:
+            self._remove(oid)
+
+    def _remove(self, oid):
+        # Caller must hold the lock
+        entry = self._entries.pop(oid, None)
+        if entry is not None:
+            self.total_bytes -= len(entry[1])
+
+
+def canonical_criteria(criteria):
+    """Return a canonical string form of search criteria
+
+    Equivalent criteria, regardless of key order, produce the same
+    string.  Types JSON can't represent natively (i.e. datetime,
+    ObjectId) are tagged with their type name so they won't collide
+    with plain strings.
+
+    """
+    def tag(obj):
+        if hasattr(obj, 'isoformat'):
+            return {'$' + type(obj).__name__: obj.isoformat()}
+        return {'$' + type(obj).__name__: str(obj)}
+
+    return json.dumps(criteria, sort_keys=True, separators=(',', ':'),
+                      default=tag)
+
+
+class SearchCache(object):
+    """Cache of search results, invalidated by write generation
+
+    Results are keyed by the canonical form of the search criteria
+    and limit.  Any write to the document store (upload, delete,
+    transfer) should call `bump()`, advancing the generation and
+    thereby invalidating every previously cached result.
+
+    At most `max_entries` results are retained, evicting the least
+    recently used.  Results listing more than `max_documents` aren't
+    cached at all, but streamed as they are read.
+
+    :param shared: set when other processes write to the same
+      database, i.e. prefork workers, so searches `sync` with the
+      change feed first
+
+    """
+    def __init__(self, max_entries, max_documents=1000, shared=False):
+        self.max_entries = max_entries
+        self.max_documents = max_documents
+        self.shared = shared
+        self.generation = 0
+        self._token = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, criteria, limit):
+        return (canonical_criteria(criteria), limit)
+
+    def get(self, key):
+        """Return (True, result) on a hit, (False, None) otherwise"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != self.generation:
+                return False, None
+            self._entries[key] = entry
+            return True, entry[1]
+
+    def put(self, key, result, generation):
+        """Cache result, if generation is still current
+
+        :param generation: the generation read before the search was
+          run, so a write racing the search can't leave a stale result
+
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (generation, result)
+
+    def bump(self):
+        """Advance the write generation, invalidating all results"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def sync(self, token):
+        """Bump should token, noting the last shared write, have changed
+
+        Lets caches in separate processes notice each other's writes,
+        i.e. via the id of the latest change feed event.
+
+        """
+        with self._lock:
+            if token == self._token:
+                return
+            self._token = token
+        self.bump()
@@ -0,0 +1,54 @@
+import os
+import threading
+
+import pymongo
+
+
+def connect(settings):
+    """Return a new mongo client, as configured in settings"""
+    if settings.get('db_replica_set'):
+        return pymongo.MongoReplicaSetClient(
+            settings['db_uri'], replicaSet=settings['db_replica_set'])
+    return pymongo.Connection(settings['db_uri'])
+
+
+class ForkSafeClient(object):
+    """Mongo client created lazily, and afresh in each process
+
+    The sockets of a client can't be shared with a forked child.  A
+    process touching this proxy gets a client of its own, so it is
+    safe to create in main() before workers are forked.  Databases
+    are looked up as on a client, i.e. `db_conn[db_name]`.
+
+    :param factory: callable returning a new client
+
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._client = self._factory()
+                    self._pid = pid
+        return self._client
+
+    def disconnect(self):
+        """Close this process's client, if any, before forking"""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.disconnect()
+            self._client = None
+            self._pid = None
+
+    def __getitem__(self, name):
+        return self.client[name]
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,133 @@
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from pheme.util.config import Config
+from pheme.webAPI.events import EVENT_ATTRIBUTES, record_event
+from pheme.webAPI.report_types import Buckets
+from pheme.webAPI.resources import PHINMS_Transfer
+
+
+def phinms_directories():
+    """Return the outgoing directories configured in the [phinms] section"""
+    return sorted(set(os.path.normpath(path) for _, path in
+                      Config().items('phinms')))
+
+
+class DeliveryWatcher(threading.Thread):
+    """Confirm delivery of documents handed to PHIN-MS
+
+    PHIN-MS consumes files dropped into its outgoing directories.  A
+    file disappearing from an outgoing directory is taken as
+    confirmation of delivery, and the matching transfer history entry
+    of the document is marked `delivered`, along with the document's
+    `delivered_date`, and a 'delivered' event is recorded for the
+    change feed (and thereby the search caches of every worker).
+
+    Uses inotify (via the optional pyinotify package) to notice
+    consumed files within moments.  A polling pass is made on startup,
+    to catch deliveries made while the watcher wasn't running, and
+    every `poll_interval` seconds thereafter, even while watching, to
+    reconcile any events inotify missed (i.e. on queue overflow).
+
+    """
+    def __init__(self, settings, directories, poll_interval=30):
+        super(DeliveryWatcher, self).__init__(name='DeliveryWatcher')
+        self.daemon = True
+        self.settings = settings
+        self.directories = directories
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+
+    @property
+    def buckets(self):
+        return Buckets(self.settings['db_conn'][self.settings['db_name']])
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        self.poll()
+        if pyinotify is not None:
+            try:
+                self.watch()
+                return
+            except Exception:
+                logging.exception("inotify watch failed, polling instead")
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("delivery poll failed")
+
+    def watch(self):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                watcher.delivered(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, Handler(), timeout=1000)
+        manager.add_watch(self.directories,
+                          pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM)
+        logging.info("watching %s for PHIN-MS delivery", self.directories)
+        next_poll = time.time() + self.poll_interval
+        try:
+            while not self._stop_event.is_set():
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+                if time.time() >= next_poll:
+                    try:
+                        self.poll()
+                    except Exception:
+                        logging.exception("delivery poll failed")
+                    next_poll = time.time() + self.poll_interval
+        finally:
+            notifier.stop()
+
+    def pending(self):
+        """Generate (bucket, path) for each undelivered PHIN-MS transfer"""
+        criteria = {'transfers': {'$elemMatch': {
+            'agent': PHINMS_Transfer.name, 'delivered': False}}}
+        for bucket in self.buckets.all():
+            for document in bucket.files.find(criteria,
+                                              fields=['transfers']):
+                for transfer in document['transfers']:
+                    if transfer.get('delivered') is False:
+                        yield bucket, transfer['path']
+
+    def poll(self):
+        """Mark delivered any pending transfers whose file is gone"""
+        for bucket, path in self.pending():
+            if not os.path.exists(path):
+                self.delivered(path, [bucket])
+
+    def delivered(self, path, buckets=None):
+        """Mark the pending transfer of the file at path delivered"""
+        now = datetime.utcnow()
+        for bucket in buckets or self.buckets.all():
+            document = bucket.files.find_and_modify(
+                {'transfers': {'$elemMatch': {'path': path,
+                                              'delivered': False}}},
+                {'$set': {'transfers.$.delivered': True,
+                          'transfers.$.delivered_date': now,
+                          'delivered_date': now}},
+                fields=list(EVENT_ATTRIBUTES), new=True)
+            if document:
+                logging.info("PHIN-MS delivered %s", path)
+                record_event(bucket.files.database, 'delivered',
+                             [document])
+                search_cache = self.settings.get('search_cache')
+                if search_cache is not None:
+                    search_cache.bump()
+                return True
+        return False
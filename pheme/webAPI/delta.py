@@ -0,0 +1,307 @@
+"""Delta encoding of repeatedly uploaded documents
+
+Successive versions of longitudinal files are mostly identical.  Rather
+than storing each version in full, a version may be stored as a delta
+against the most recent full snapshot of the same report.  Every
+delta references its snapshot directly (never another delta), so a
+version is reconstructed by streaming one delta against one snapshot.
+
+The delta is a sequence of operations, each either copying a range of
+the snapshot or inserting literal bytes::
+
+    'PHD1' header
+    'C' offset length    (unsigned 64 bit, big endian)
+    'I' length data
+
+Matching is done a line at a time, suited to the record oriented
+files this is used for, though any content round trips correctly.
+Only the first `max_index_lines` lines of a snapshot are indexed,
+bounding the memory used to encode against very large snapshots;
+content matching lines past that point is stored as inserts, which
+generally means the delta isn't worth it and a new snapshot is stored.
+
+"""
+import hashlib
+import logging
+import struct
+from tempfile import SpooledTemporaryFile
+
+from pheme.webAPI.packs import open_archived
+
+MAGIC = b'PHD1'
+COPY = b'C'
+INSERT = b'I'
+_COPY_FMT = '>QQ'
+_INSERT_FMT = '>Q'
+_INSERT_FLUSH = 64 * 1024
+_READ_SIZE = 64 * 1024
+
+# The index costs roughly 200 bytes a line, some 50MB at this default
+MAX_INDEX_LINES = 1 << 18
+
+
+def _digest(line):
+    return hashlib.sha1(line).digest()
+
+
+def index_lines(base, max_lines=MAX_INDEX_LINES):
+    """Index the lines of base, returning (first_offset, digest_at)
+
+    first_offset maps each line digest to the offset of its first
+    occurrence, digest_at maps each line offset to its digest.  Only
+    the first max_lines lines are indexed.
+
+    """
+    first_offset = {}
+    digest_at = {}
+    offset = 0
+    for line in iter(base.readline, b''):
+        if len(digest_at) >= max_lines:
+            logging.debug("snapshot index truncated at %d lines", max_lines)
+            break
+        digest = _digest(line)
+        first_offset.setdefault(digest, offset)
+        digest_at[offset] = digest
+        offset += len(line)
+    return first_offset, digest_at
+
+
+def encode(base, target, out, max_index_lines=MAX_INDEX_LINES):
+    """Write the delta transforming base into target to out
+
+    :param base: file-like object with the snapshot content
+    :param target: file-like object with the new content
+    :param out: file-like object the delta is written to
+    :param max_index_lines: index at most this many snapshot lines
+
+    Returns a (target_length, delta_length) tuple.
+
+    """
+    first_offset, digest_at = index_lines(base, max_index_lines)
+    out.write(MAGIC)
+    written = len(MAGIC)
+    target_length = 0
+    copy_start = copy_end = None
+    pending = []
+    pending_length = 0
+
+    def flush_copy():
+        out.write(COPY + struct.pack(_COPY_FMT, copy_start,
+                                     copy_end - copy_start))
+        return 1 + struct.calcsize(_COPY_FMT)
+
+    def flush_insert():
+        out.write(INSERT + struct.pack(_INSERT_FMT, pending_length))
+        for data in pending:
+            out.write(data)
+        return 1 + struct.calcsize(_INSERT_FMT) + pending_length
+
+    for line in iter(target.readline, b''):
+        target_length += len(line)
+        digest = _digest(line)
+        if copy_end is not None and digest_at.get(copy_end) == digest:
+            # Contiguous with the running copy, extend it
+            copy_end += len(line)
+            continue
+        offset = first_offset.get(digest)
+        if offset is None:
+            if copy_end is not None:
+                written += flush_copy()
+                copy_start = copy_end = None
+            pending.append(line)
+            pending_length += len(line)
+            if pending_length >= _INSERT_FLUSH:
+                written += flush_insert()
+                pending, pending_length = [], 0
+            continue
+        if copy_end is not None:
+            written += flush_copy()
+        if pending:
+            written += flush_insert()
+            pending, pending_length = [], 0
+        copy_start, copy_end = offset, offset + len(line)
+
+    if copy_end is not None:
+        written += flush_copy()
+    if pending:
+        written += flush_insert()
+    return target_length, written
+
+
+class DeltaReader(object):
+    """Read only file-like object reconstructing a delta encoded version
+
+    Content is produced incrementally as it is read, seeking the
+    snapshot for each copy operation, so neither the snapshot nor the
+    reconstructed version is ever held in memory.
+
+    """
+    def __init__(self, base, delta, name=None):
+        self.base = base
+        self.delta = delta
+        self.name = name
+        self._buffer = b''
+        self._chunks = self._generate()
+        if delta.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a delta encoded document")
+
+    def _generate(self):
+        copy_size = struct.calcsize(_COPY_FMT)
+        insert_size = struct.calcsize(_INSERT_FMT)
+        while True:
+            op = self.delta.read(1)
+            if not op:
+                return
+            if op == COPY:
+                offset, length = struct.unpack(
+                    _COPY_FMT, self.delta.read(copy_size))
+                self.base.seek(offset)
+                stream = self.base
+            elif op == INSERT:
+                length, = struct.unpack(_INSERT_FMT,
+                                        self.delta.read(insert_size))
+                stream = self.delta
+            else:
+                raise ValueError("corrupt delta, unknown op %r" % op)
+            while length:
+                data = stream.read(min(length, _READ_SIZE))
+                if not data:
+                    raise ValueError("corrupt delta, truncated")
+                length -= len(data)
+                yield data
+
+    def read(self, size=-1):
+        """Read up to size bytes, or until exhausted if size < 0"""
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while size < 0 or available < size:
+            try:
+                data = next(self._chunks)
+            except StopIteration:
+                break
+            parts.append(data)
+            available += len(data)
+        content = b''.join(parts)
+        if size < 0:
+            self._buffer = b''
+            return content
+        self._buffer = content[size:]
+        return content[:size]
+
+    def __iter__(self):
+        while True:
+            data = self.read(_READ_SIZE)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.base.close()
+        self.delta.close()
+
+
+def open_base(fs, base_id):
+    """Return a seekable file-like object for a snapshot's content"""
+    base = fs.get(base_id)
+    pointer = getattr(base, 'archive', None)
+    if pointer:
+        # The snapshot was moved to the archive tier
+        return open_archived(pointer, base.filename)
+    return base
+
+
+def open_delta(fs, document):
+    """Return a DeltaReader for the delta encoded document"""
+    return DeltaReader(open_base(fs, document['delta_base']),
+                       fs.get(document['_id']),
+                       name=document.get('filename'))
+
+
+def put(fs, fileobj, previous, snapshot_interval, max_ratio,
+        max_index_lines=MAX_INDEX_LINES, **kwargs):
+    """Persist fileobj, as a delta against previous' snapshot if viable
+
+    :param fs: the GridFS instance to write to
+    :param fileobj: file-like object with the content to store
+    :param previous: 'fs.files' document for the previous version,
+      or None if this is the first
+    :param snapshot_interval: store a full snapshot after this many
+      consecutive deltas
+    :param max_ratio: store a full snapshot should the delta exceed
+      this fraction of the full content
+    :param max_index_lines: index at most this many snapshot lines
+    :param kwargs: additional metadata to store with the document
+
+    Returns the new document (Object) ID.
+
+    """
+    if previous is None or previous.get('compression') or\
+            previous.get('delta_chain', 0) + 1 >= snapshot_interval:
+        return fs.put(fileobj, **kwargs)
+
+    base_id = previous.get('delta_base', previous['_id'])
+    with SpooledTemporaryFile(max_size=_INSERT_FLUSH * 16) as delta:
+        target_length, delta_length = encode(open_base(fs, base_id), fileobj,
+                                             delta, max_index_lines)
+        delta.seek(0)
+        if delta_length > target_length * max_ratio:
+            logging.debug("delta too large (%d of %d), store snapshot",
+                          delta_length, target_length)
+            fileobj.seek(0)
+            return fs.put(fileobj, **kwargs)
+        kwargs.update({'storage': 'delta',
+                       'delta_base': base_id,
+                       'delta_chain': previous.get('delta_chain', 0) + 1,
+                       'content_length': target_length})
+        return fs.put(delta, **kwargs)
+
+
+def rebase_dependents(fs, document_store, base_id, exclude=()):
+    """Re-store versions depending on base_id, before it is removed
+
+    The oldest dependent is rewritten as a full snapshot under its
+    existing document id, the remaining dependents are re-encoded
+    against it.
+
+    :param exclude: document ids being removed along with the base,
+      which needn't be preserved
+
+    """
+    criteria = {'delta_base': base_id}
+    if exclude:
+        criteria['_id'] = {'$nin': list(exclude)}
+    dependents = list(document_store.find(criteria).sort('version', 1))
+    snapshot = None
+    for document in dependents:
+        with SpooledTemporaryFile(max_size=_INSERT_FLUSH * 16) as content:
+            reader = open_delta(fs, document)
+            for data in reader:
+                content.write(data)
+            reader.close()
+            content.seek(0)
+
+            metadata = dict((k, v) for k, v in document.items()
+                            if k not in ('_id', 'length', 'chunkSize',
+                                         'uploadDate', 'md5', 'storage',
+                                         'delta_base', 'delta_chain',
+                                         'content_length'))
+            fs.delete(document['_id'])
+            if snapshot is None:
+                fs.put(content, _id=document['_id'], **metadata)
+                snapshot = document['_id']
+            else:
+                with SpooledTemporaryFile(max_size=_INSERT_FLUSH * 16)\
+                        as delta:
+                    target_length, _ = encode(fs.get(snapshot), content,
+                                              delta)
+                    delta.seek(0)
+                    fs.put(delta, _id=document['_id'], storage='delta',
+                           delta_base=snapshot,
+                           delta_chain=document['delta_chain'],
+                           content_length=target_length, **metadata)
+            # GridFS stamps a new uploadDate, retain the original
+            document_store.update({'_id': document['_id']},
+                                  {'$set': {'uploadDate':
+                                            document['uploadDate']}})
+    if dependents:
+        logging.info("rebased %d versions off %s", len(dependents), base_id)
@@ -0,0 +1,92 @@
+"""Metadata derived from document content as it is uploaded"""
+import hashlib
+
+# Longest header row retained, should a file lack newlines
+_MAX_HEADER = 64 * 1024
+
+
+class DerivedMetadataReader(object):
+    """File-like wrapper deriving metadata from the content read through
+
+    Wrap the (uncompressed) upload stream, and hand the wrapper to
+    whatever consumes it: compression, GridFS or delta encoding.  Once
+    consumed, `metadata()` returns the uncompressed length, record
+    count and sha256 of the content, without a second pass.
+
+    Seeking back to the start (as delta encoding does, should it fall
+    back to a full snapshot) restarts the derivation.
+
+    :param fileobj: the file-like object to wrap
+    :param header: the content is CSV style, with a header row which
+      is retained as `header_row` and not counted as a record
+
+    """
+    def __init__(self, fileobj, header=False):
+        self.fileobj = fileobj
+        self.header = header
+        self._reset()
+
+    def _reset(self):
+        self.length = 0
+        self.lines = 0
+        self.sha256 = hashlib.sha256()
+        self.header_row = None
+        self._first_line = b''
+        self._last = b''
+
+    @property
+    def name(self):
+        return getattr(self.fileobj, 'name', None)
+
+    def read(self, size=-1):
+        return self._consume(self.fileobj.read(size))
+
+    def readline(self, size=-1):
+        return self._consume(self.fileobj.readline(size))
+
+    def _consume(self, data):
+        if data:
+            self.length += len(data)
+            self.lines += data.count(b'\n')
+            self.sha256.update(data)
+            self._last = data[-1:]
+            if self.header_row is None:
+                self._first_line += data[:_MAX_HEADER]
+                end = self._first_line.find(b'\n')
+                if end >= 0 or len(self._first_line) >= _MAX_HEADER:
+                    self.header_row = self._first_line[:end if end >= 0
+                                                       else _MAX_HEADER]
+                    self._first_line = b''
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0:
+            raise IOError("can only seek to the start of derived content")
+        self.fileobj.seek(0)
+        self._reset()
+
+    def tell(self):
+        return self.length
+
+    def close(self):
+        self.fileobj.close()
+
+    def metadata(self):
+        """Return the metadata derived from the content read so far"""
+        records = self.lines
+        if self.length and self._last != b'\n':
+            records += 1  # final line lacks a newline
+        derived = {'uncompressed_length': self.length,
+                   'sha256': self.sha256.hexdigest()}
+        if self.header:
+            header_row = self.header_row
+            if header_row is None:
+                header_row = self._first_line
+            derived['header_row'] = header_row.rstrip(b'\r').\
+                decode('utf-8', 'replace')
+            records = max(records - 1, 0)
+        derived['record_count'] = records
+        return derived
@@ -0,0 +1,194 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+import json
+import logging
+import threading
+import time
+
+from pymongo.errors import CollectionInvalid
+
+EVENT_COLLECTION = 'events'
+SEQUENCE_COLLECTION = 'events.seq'
+
+# document attributes copied into each event, for consumers to filter on
+EVENT_ATTRIBUTES = ('report_type', 'reportable_region', 'patient_class',
+                    'filename')
+
+
+def ensure_event_log(db, size):
+    """Create the capped event collection, if it doesn't already exist
+
+    :param size: maximum size of the event log in bytes, the oldest
+      events are discarded once full
+
+    """
+    try:
+        db.create_collection(EVENT_COLLECTION, capped=True, size=size)
+    except CollectionInvalid:
+        pass  # already exists
+    db[EVENT_COLLECTION].ensure_index('seq')
+
+
+def next_sequence(db, count=1):
+    """Reserve count event sequence numbers, returning the first
+
+    The counter is incremented server side, so sequence numbers
+    increase across every process and host sharing the database,
+    unlike client generated ObjectIds.
+
+    """
+    counter = db[SEQUENCE_COLLECTION].find_and_modify(
+        {'_id': EVENT_COLLECTION}, {'$inc': {'seq': count}},
+        upsert=True, new=True)
+    return counter['seq'] - count + 1
+
+
+def record_event(db, event, documents):
+    """Append an event to the change feed for each document
+
+    :param db: the database holding the event log
+    :param event: the event type, i.e. 'upload', 'update', 'delete',
+      'transfer', 'delivered'
+    :param documents: the 'fs.files' documents the event applies to
+
+    Each event is numbered by `next_sequence`, consumers resume from
+    the last `seq` seen.
+
+    """
+    now = datetime.utcnow()
+    entries = []
+    for document in documents:
+        entry = dict((k, document[k]) for k in EVENT_ATTRIBUTES
+                     if k in document)
+        entry.update({'_id': ObjectId(), 'event': event, 'date': now,
+                      'document_id': document['_id']})
+        entries.append(entry)
+    if entries:
+        seq = next_sequence(db, len(entries))
+        for i, entry in enumerate(entries):
+            entry['seq'] = seq + i
+        db[EVENT_COLLECTION].insert(entries)
+
+
+def latest_event_id(db):
+    """Return the id of the most recent event, None if there are none"""
+    for event in db[EVENT_COLLECTION].find(fields=['_id']).sort(
+            '$natural', -1).limit(1):
+        return event['_id']
+    return None
+
+
+def event_criteria(since=None, **filters):
+    """Return criteria for events after since, matching filters
+
+    :param since: the sequence number (`seq`) of the last event seen,
+      None for all.  Raises ValueError if not a number.
+    :param filters: event attributes to match, i.e. report_type
+
+    """
+    criteria = dict((k, v) for k, v in filters.items() if v)
+    if since is not None:
+        criteria['seq'] = {'$gt': int(since)}
+    return criteria
+
+
+def tail_events(db, criteria, timeout):
+    """Generate events matching criteria as they are appended
+
+    Follows the capped event log with a tailable cursor, starting
+    with any existing matching events.  Yields None whenever no event
+    arrives for a while, letting the caller send keep alives or give
+    up, and stops once timeout seconds have elapsed.
+
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        cursor = db[EVENT_COLLECTION].find(criteria, tailable=True,
+                                           await_data=True)
+        while cursor.alive and time.time() < deadline:
+            try:
+                event = cursor.next()
+            except StopIteration:
+                # await_data already blocked a while server side
+                yield None
+                continue
+            criteria['seq'] = {'$gt': event['seq']}
+            yield event
+        # A tailable cursor dies on an empty result, wait and retry
+        if time.time() < deadline:
+            yield None
+            time.sleep(1)
+
+
+def encode_event(event):
+    """Return the event JSON encoded"""
+    def adapt(obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        raise TypeError(repr(obj))
+    return json.dumps(event, default=adapt)
+
+
+def server_sent_events(db, criteria, timeout):
+    """Generate Server-Sent Events text for the matching events
+
+    Each event carries its sequence number as id, so a reconnecting
+    EventSource resumes from the Last-Event-ID.  Comments are sent as
+    keep alives while idle.
+
+    """
+    yield 'retry: 2000\n\n'
+    for event in tail_events(db, criteria, timeout):
+        if event is None:
+            yield ': keep alive\n\n'
+            continue
+        logging.debug("change feed event %s", event['seq'])
+        yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+            event['seq'], event['event'], encode_event(event))
+
+
+class ConsumerLimit(object):
+    """Limit the change feed consumers served at once
+
+    Each consumer holds a server thread for as long as it waits on
+    the feed, up to its timeout, so only `max_consumers` may do so
+    at once, leaving the remaining threads for everything else.
+
+    """
+    def __init__(self, max_consumers):
+        self.max_consumers = max_consumers
+        self.consumers = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Claim a consumer slot, returning False if none is free"""
+        with self._lock:
+            if self.consumers >= self.max_consumers:
+                return False
+            self.consumers += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.consumers -= 1
+
+
+class ReleasingIterable(object):
+    """Response body calling release once the server closes it"""
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        release, self._release = self._release, None
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            if release is not None:
+                release()
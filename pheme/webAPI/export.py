@@ -0,0 +1,193 @@
+"""Streaming tar and zip archives of stored documents
+
+Archives are generated incrementally, member by member, straight from
+the stored content.  Nothing is staged on disk or held in memory
+beyond a single read buffer, so exports of any size are possible.
+
+"""
+import calendar
+import struct
+import tarfile
+import time
+import zlib
+
+from pheme.util.compression import expand_file
+
+_READ_SIZE = 64 * 1024
+_ZIP64_LIMIT = 0xFFFFFFFF
+
+
+def content_length(document):
+    """Length of a document's content as stored, before any expansion"""
+    if document.get('archive'):
+        return document['archive']['length']
+    if document.get('storage') == 'delta':
+        return document['content_length']
+    return document['length']
+
+
+def expanded_name(filename, compression):
+    """Drop the compression suffix a compressed upload was given"""
+    for suffix in {'gzip': ('.gz',), 'zip': ('.zip',)}.get(compression, ()):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def expand_stream(fileobj, compression):
+    """Generate the expanded content of fileobj, a read buffer at a time
+
+    gzip content is inflated incrementally.  zip content is handed to
+    pheme.util's expand_file, as a zip member can't be read without
+    the archive's central directory.
+
+    """
+    if compression == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for data in iter(lambda: fileobj.read(_READ_SIZE), b''):
+            yield decompressor.decompress(data)
+        yield decompressor.flush()
+    else:
+        if compression:
+            fileobj = expand_file(fileobj=fileobj, zip_protocol=compression)
+        for data in iter(lambda: fileobj.read(_READ_SIZE), b''):
+            yield data
+
+
+class Member(object):
+    """An archive member, opened only when its content is streamed
+
+    :param name: name of the member within the archive
+    :param mtime: modification time, as a naive UTC datetime (i.e.
+      the uploadDate)
+    :param open: callable returning an iterable of content blocks
+    :param size: content length, if known up front
+
+    """
+    def __init__(self, name, mtime, open, size=None):
+        self.name = name
+        self.mtime = calendar.timegm(mtime.utctimetuple())
+        self.open = open
+        self.size = size
+
+
+def tar_stream(members):
+    """Generate a tar archive of members
+
+    tar headers precede the content and must declare its size.  A
+    member with unknown size (i.e. to be expanded) is read twice, once
+    to measure it.
+
+    """
+    for member in members:
+        size = member.size
+        if size is None:
+            size = sum(len(data) for data in member.open())
+        info = tarfile.TarInfo(member.name)
+        info.size = size
+        info.mtime = member.mtime
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        written = 0
+        for data in member.open():
+            written += len(data)
+            yield data
+        if written != size:
+            raise IOError("member %s changed size while streaming" %
+                          member.name)
+        if size % tarfile.BLOCKSIZE:
+            yield b'\0' * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+            t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+
+def zip_stream(members, deflate=False):
+    """Generate a zip archive of members
+
+    Sizes and CRCs follow each member's content in a data descriptor,
+    so members are streamed in a single pass.  Zip64 extensions are
+    used throughout the local headers, and in the central directory
+    wherever sizes, offsets or the member count require.
+
+    :param deflate: compress members, otherwise they are stored as is
+
+    """
+    method = 8 if deflate else 0  # deflated or stored
+    flags = 0x08 | 0x800  # data descriptor follows, utf-8 names
+    offset = 0
+    central = []
+    for member in members:
+        name = member.name.encode('utf-8')
+        dos_date, dos_time = _dos_time(member.mtime)
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        header = struct.pack('<4s5H3L2H', b'PK\x03\x04', 45, flags,
+                             method, dos_time, dos_date, 0, _ZIP64_LIMIT,
+                             _ZIP64_LIMIT, len(name), len(extra))
+        header += name + extra
+        yield header
+
+        crc = 0
+        size = compressed_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15) if deflate\
+            else None
+        for data in member.open():
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            if compressor:
+                data = compressor.compress(data)
+            compressed_size += len(data)
+            if data:
+                yield data
+        if compressor:
+            data = compressor.flush()
+            compressed_size += len(data)
+            yield data
+        crc &= 0xFFFFFFFF
+        yield struct.pack('<4sLQQ', b'PK\x07\x08', crc, compressed_size,
+                          size)
+        central.append((name, dos_time, dos_date, crc, compressed_size,
+                        size, offset))
+        offset += len(header) + compressed_size + 24
+
+    cd_start = offset
+    cd_size = 0
+    for name, dos_time, dos_date, crc, compressed_size, size, local in\
+            central:
+        zip64 = []
+        if size >= _ZIP64_LIMIT:
+            zip64.append(size)
+            size = _ZIP64_LIMIT
+        if compressed_size >= _ZIP64_LIMIT:
+            zip64.append(compressed_size)
+            compressed_size = _ZIP64_LIMIT
+        if local >= _ZIP64_LIMIT:
+            zip64.append(local)
+            local = _ZIP64_LIMIT
+        extra = struct.pack('<HH%dQ' % len(zip64), 0x0001, 8 * len(zip64),
+                            *zip64) if zip64 else b''
+        entry = struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 45, 45, flags,
+                            method, dos_time, dos_date, crc,
+                            compressed_size, size, len(name), len(extra),
+                            0, 0, 0, 0o644 << 16, local)
+        entry += name + extra
+        cd_size += len(entry)
+        yield entry
+
+    count = len(central)
+    if count >= 0xFFFF or cd_size >= _ZIP64_LIMIT or\
+            cd_start >= _ZIP64_LIMIT:
+        zip64_end = cd_start + cd_size
+        yield struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                          count, count, cd_size, cd_start)
+        yield struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_end, 1)
+        count = min(count, 0xFFFF)
+        cd_size = min(cd_size, _ZIP64_LIMIT)
+        cd_start = min(cd_start, _ZIP64_LIMIT)
+    yield struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count,
+                      cd_size, cd_start, 0)
@@ -0,0 +1,167 @@
+"""Per request memory high-water instrumentation
+
+Opt in via the `memory.profile` setting.  While enabled, a sampler
+thread records the resident set size (and the traced python
+allocations, where tracemalloc is available) every `interval` seconds,
+raising the high-water mark of every request in flight.  Samples are
+process wide, so requests running concurrently share the blame for
+any growth.
+
+"""
+from collections import deque
+from datetime import datetime
+import logging
+import os
+import resource
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss():
+    """Return the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError):
+        # the high-water mark is the best available without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_traced():
+    """Return bytes currently allocated by python, 0 if not traced"""
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+class RequestMemory(object):
+    """Memory high-water of a single request, and what it was for"""
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.start = datetime.utcnow()
+        self.context = None
+        self.view_name = None
+        self.document_id = None
+        self.length = None
+        self.rss_start = current_rss()
+        self.traced_start = current_traced()
+        self.rss_peak = self.rss_start
+        self.traced_peak = self.traced_start
+        self.elapsed = None
+
+    def sample(self, rss, traced):
+        self.rss_peak = max(self.rss_peak, rss)
+        self.traced_peak = max(self.traced_peak, traced)
+
+    @property
+    def peak(self):
+        """Growth over the request, traced allocations if available"""
+        if self.traced_start or self.traced_peak:
+            return self.traced_peak - self.traced_start
+        return self.rss_peak - self.rss_start
+
+    def as_dict(self):
+        return {'method': self.method, 'path': self.path,
+                'start': self.start, 'elapsed': self.elapsed,
+                'context': self.context, 'view_name': self.view_name,
+                'document_id': self.document_id, 'length': self.length,
+                'peak': self.peak,
+                'rss_growth': self.rss_peak - self.rss_start,
+                'traced_growth': self.traced_peak - self.traced_start}
+
+
+class MemoryMonitor(threading.Thread):
+    """Sample memory for requests in flight, keeping the recent ones
+
+    :param interval: seconds between samples
+    :param threshold: requests growing memory by at least this many
+      bytes are logged
+    :param keep: number of recent requests kept for reporting
+
+    """
+    def __init__(self, interval=0.05, threshold=64 * 1024 * 1024,
+                 keep=1000):
+        super(MemoryMonitor, self).__init__(name='MemoryMonitor')
+        self.daemon = True
+        self.interval = interval
+        self.threshold = threshold
+        self.recent = deque(maxlen=keep)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss, traced = current_rss(), current_traced()
+        with self._lock:
+            for record in self._active:
+                record.sample(rss, traced)
+
+    def begin(self, method, path):
+        record = RequestMemory(method, path)
+        with self._lock:
+            self._active.add(record)
+        return record
+
+    def end(self, record):
+        record.sample(current_rss(), current_traced())
+        record.elapsed = (datetime.utcnow() - record.start).total_seconds()
+        with self._lock:
+            self._active.discard(record)
+            self.recent.append(record)
+        if record.peak >= self.threshold:
+            logging.warning("%s %s (%s %s, document %s of %s bytes) grew "
+                            "memory by %d bytes", record.method,
+                            record.path, record.context, record.view_name,
+                            record.document_id, record.length, record.peak)
+
+    def worst(self, limit=20):
+        """Return the recent requests with the highest peaks"""
+        with self._lock:
+            records = list(self.recent)
+        records.sort(key=lambda record: record.peak, reverse=True)
+        return [record.as_dict() for record in records[:limit]]
+
+
+def tag_document(request, document, length=None):
+    """Note the document a request is handling, if being profiled"""
+    record = getattr(request, 'memory', None)
+    if record is not None:
+        record.document_id = document['_id']
+        record.length = length if length is not None else\
+            document.get('length')
+
+
+def memory_tween_factory(handler, registry):
+    """Tween recording the memory high-water of every request"""
+    monitor = registry.settings.get('memory_monitor')
+    if monitor is None:
+        return handler
+
+    def memory_tween(request):
+        record = monitor.begin(request.method, request.path)
+        request.memory = record
+        try:
+            return handler(request)
+        finally:
+            context = getattr(request, 'context', None)
+            if context is not None:
+                record.context = context.__class__.__name__
+            record.view_name = getattr(request, 'view_name', None)
+            monitor.end(record)
+    return memory_tween
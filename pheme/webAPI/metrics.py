@@ -0,0 +1,131 @@
+"""Request metrics, aggregated across worker processes
+
+Each process counts its own requests, and a publisher thread writes
+the counts to the `metrics` collection every `interval` seconds, one
+document per process.  Summing the recently updated documents gives
+the totals for every worker, on any host, sharing the database.
+
+"""
+from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import threading
+import time
+
+METRICS_COLLECTION = 'metrics'
+
+# Worker documents not updated for this long are expired by mongo
+_EXPIRE_SECONDS = 24 * 60 * 60
+
+
+class WorkerMetrics(object):
+    """Request counts for this process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start counting afresh, i.e. in a newly forked worker"""
+        self.started = datetime.utcnow()
+        self.counts = {'requests': 0, 'in_flight': 0, 'seconds': 0.0,
+                       '2xx': 0, '3xx': 0, '4xx': 0, '5xx': 0}
+
+    def begin(self):
+        with self._lock:
+            self.counts['requests'] += 1
+            self.counts['in_flight'] += 1
+
+    def end(self, status, seconds):
+        with self._lock:
+            self.counts['in_flight'] -= 1
+            self.counts['seconds'] += seconds
+            status_class = '%dxx' % (status // 100)
+            if status_class in self.counts:
+                self.counts[status_class] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+def metrics_tween_factory(handler, registry):
+    """Tween counting requests, by status, and the time taken"""
+    metrics = registry.settings.get('metrics')
+    if metrics is None:
+        return handler
+
+    def metrics_tween(request):
+        start = time.time()
+        metrics.begin()
+        status = 500
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            metrics.end(status, time.time() - start)
+    return metrics_tween
+
+
+def ensure_metrics(db):
+    """Expire the documents of workers no longer publishing"""
+    db[METRICS_COLLECTION].ensure_index(
+        'updated', expireAfterSeconds=_EXPIRE_SECONDS)
+
+
+class MetricsPublisher(threading.Thread):
+    """Publish this process's metrics every `interval` seconds
+
+    Cache sizes are included alongside the request counts.
+
+    """
+    def __init__(self, settings, interval):
+        super(MetricsPublisher, self).__init__(name='MetricsPublisher')
+        self.daemon = True
+        self.settings = settings
+        self.interval = interval
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.publish()
+            except Exception:
+                logging.exception("metrics publish failed")
+
+    def publish(self):
+        metrics = self.settings['metrics']
+        document = metrics.snapshot()
+        content_cache = self.settings.get('content_cache')
+        if content_cache is not None:
+            document['content_cache_bytes'] = content_cache.total_bytes
+        search_cache = self.settings.get('search_cache')
+        if search_cache is not None:
+            document['search_cache_entries'] = len(search_cache)
+        document.update({'started': metrics.started,
+                         'updated': datetime.utcnow()})
+        db = self.settings['db_conn'][self.settings['db_name']]
+        db[METRICS_COLLECTION].update({'_id': self.worker},
+                                      {'$set': document}, upsert=True)
+
+
+def aggregate(db, max_age):
+    """Sum the metrics of workers publishing in the last max_age seconds
+
+    Returns the totals, along with each worker's own metrics.
+
+    """
+    since = datetime.utcnow() - timedelta(seconds=max_age)
+    workers = list(db[METRICS_COLLECTION].find({'updated': {'$gte': since}}))
+    totals = {}
+    for worker in workers:
+        for k, v in worker.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                totals[k] = totals.get(k, 0) + v
+    return {'workers': len(workers), 'totals': totals,
+            'per_worker': workers}
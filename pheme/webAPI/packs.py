@@ -0,0 +1,230 @@
+"""Append only, compressed pack files for archived documents
+
+Archived documents are moved out of GridFS into pack files on local
+disk, leaving only the 'fs.files' metadata in mongo along with an
+`archive` pointer naming the pack and offset of the document's record.
+Each record is::
+
+    'PHPK' magic
+    raw length, compressed length    (unsigned 64 bit, big endian)
+    12 byte document (Object) ID
+    zlib compressed content
+
+A sidecar index file, one line per record of ``<oid> <offset>``,
+permits pointers to be verified or rebuilt from the packs alone.
+
+"""
+from bson.objectid import ObjectId
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+MAGIC = b'PHPK'
+_HEADER_FMT = '>4sQQ12s'
+_HEADER_SIZE = struct.calcsize(_HEADER_FMT)
+_READ_SIZE = 64 * 1024
+
+_pack_store = None
+
+
+def configure(directory, max_pack_bytes=1 << 30):
+    """Configure the module wide pack store, returning it"""
+    global _pack_store
+    _pack_store = PackStore(directory, max_pack_bytes)
+    return _pack_store
+
+
+def get_pack_store():
+    """Return the configured pack store, or raise if not configured"""
+    if _pack_store is None:
+        raise RuntimeError("archive.directory not configured, can't "
+                           "access archived documents")
+    return _pack_store
+
+
+def open_archived(pointer, name=None):
+    """Return a file-like object for an archived document's content
+
+    :param pointer: the `archive` entry of the 'fs.files' document
+    :param name: optional name for the file-like object, typically
+      the document's filename
+
+    """
+    return get_pack_store().open(pointer, name)
+
+
+class PackStore(object):
+    """Directory of pack files, read via mmap
+
+    New records are appended to the newest pack until it exceeds
+    `max_pack_bytes`, when a new pack is started.  Packs are never
+    rewritten.
+
+    """
+    def __init__(self, directory, max_pack_bytes=1 << 30):
+        self.directory = directory
+        self.max_pack_bytes = max_pack_bytes
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _path(self, pack):
+        return os.path.join(self.directory, pack)
+
+    def _current_pack(self):
+        packs = sorted(f for f in os.listdir(self.directory)
+                       if f.endswith('.pack'))
+        if packs and os.path.getsize(self._path(packs[-1])) <\
+                self.max_pack_bytes:
+            return packs[-1]
+        return 'pack-%05d.pack' % (len(packs) + 1)
+
+    def append(self, oid, fileobj):
+        """Compress and append the content of fileobj as a new record
+
+        The pack and index are flushed to disk before returning the
+        pointer, so the caller may safely drop the GridFS chunks.
+
+        Returns the pointer to store with the document.
+
+        """
+        with self._lock:
+            # Created by the first append, not when the app starts
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            pack = self._current_pack()
+            # Append mode would ignore the seek to write the header
+            open(self._path(pack), 'ab').close()
+            with open(self._path(pack), 'r+b') as out:
+                out.seek(0, os.SEEK_END)
+                offset = out.tell()
+                out.write(b'\0' * _HEADER_SIZE)  # placeholder header
+                compressor = zlib.compressobj()
+                raw_length = compressed_length = 0
+                for data in iter(lambda: fileobj.read(_READ_SIZE), b''):
+                    raw_length += len(data)
+                    data = compressor.compress(data)
+                    compressed_length += len(data)
+                    out.write(data)
+                data = compressor.flush()
+                compressed_length += len(data)
+                out.write(data)
+                out.seek(offset)
+                out.write(struct.pack(_HEADER_FMT, MAGIC, raw_length,
+                                      compressed_length, oid.binary))
+                out.flush()
+                os.fsync(out.fileno())
+            with open(self._path(pack[:-len('.pack')] + '.idx'),
+                      'a') as index:
+                index.write("%s %d\n" % (oid, offset))
+                index.flush()
+                os.fsync(index.fileno())
+        logging.debug("archived %s to %s@%d", oid, pack, offset)
+        return {'pack': pack, 'offset': offset, 'length': raw_length,
+                'stored_length': compressed_length}
+
+    def _map(self, pack, end):
+        """Return an mmap of pack covering at least `end` bytes"""
+        with self._lock:
+            mapped = self._maps.get(pack)
+            if mapped is None or len(mapped) < end:
+                # Packs only grow, remap to pick up appended records
+                with open(self._path(pack), 'rb') as fh:
+                    mapped = mmap.mmap(fh.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                self._maps[pack] = mapped
+            return mapped
+
+    def open(self, pointer, name=None):
+        """Return an ArchiveReader for the record at pointer"""
+        offset = pointer['offset']
+        mapped = self._map(pointer['pack'], offset + _HEADER_SIZE)
+        magic, raw_length, compressed_length, oid = struct.unpack(
+            _HEADER_FMT, mapped[offset:offset + _HEADER_SIZE])
+        if magic != MAGIC:
+            raise ValueError("no archive record at %(pack)s@%(offset)d"
+                             % pointer)
+        start = offset + _HEADER_SIZE
+        mapped = self._map(pointer['pack'], start + compressed_length)
+        return ArchiveReader(mapped, start, compressed_length, raw_length,
+                             ObjectId(oid), name)
+
+
+class ArchiveReader(object):
+    """Read only file-like object over a compressed pack record
+
+    Decompresses incrementally from the mmap.  Forward seeks skip
+    ahead, backward seeks restart decompression from the start of the
+    record.
+
+    """
+    def __init__(self, mapped, start, compressed_length, length, oid,
+                 name=None):
+        self._mapped = mapped
+        self._start = start
+        self._end = start + compressed_length
+        self.length = length
+        self.oid = oid
+        self.name = name or str(oid)
+        self._rewind()
+
+    def _rewind(self):
+        self._decompressor = zlib.decompressobj()
+        self._in_pos = self._start
+        self._buffer = b''
+        self._position = 0
+
+    def _fill(self, size):
+        while len(self._buffer) < size and self._in_pos < self._end:
+            end = min(self._in_pos + _READ_SIZE, self._end)
+            data = self._mapped[self._in_pos:end]
+            self._in_pos = end
+            self._buffer += self._decompressor.decompress(data)
+            if self._in_pos == self._end:
+                self._buffer += self._decompressor.flush()
+
+    def read(self, size=-1):
+        """Read up to size bytes, or until exhausted if size < 0"""
+        if size < 0:
+            size = self.length - self._position
+        self._fill(size)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        """Read through the next newline, or up to size bytes"""
+        while b'\n' not in self._buffer and self._in_pos < self._end and\
+                (size < 0 or len(self._buffer) < size):
+            self._fill(len(self._buffer) + _READ_SIZE)
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self.length
+        if position < self._position:
+            self._rewind()
+        while self._position < position:
+            if not self.read(min(position - self._position, _READ_SIZE)):
+                break
+
+    def tell(self):
+        return self._position
+
+    def __iter__(self):
+        while True:
+            data = self.read(_READ_SIZE)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        # The mmap is shared by all readers of the pack
+        self._buffer = b''
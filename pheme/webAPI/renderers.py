@@ -1,4 +1,5 @@
 import datetime
+import json
 from bson.objectid import ObjectId
 
 from pyramid.renderers import JSON
@@ -15,6 +16,79 @@ json_renderer = JSON()
 json_renderer.add_adapter(datetime.datetime, datetime_adapter)
 json_renderer.add_adapter(ObjectId, bson_objectid_adapter)
 
+try:
+    string_types = basestring
+except NameError:  # python 3
+    string_types = str
+
+# BSON types needing conversion, looked up by exact type rather than
+# walking the registered adapters for every object
+BSON_CONVERSIONS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    ObjectId: str,
+}
+
+# Results are sent in blocks of at least this many bytes
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def _convert(obj):
+    try:
+        return BSON_CONVERSIONS[type(obj)](obj)
+    except KeyError:
+        raise TypeError("%r is not JSON serializable" % obj)
+
+
+_encode = json.JSONEncoder(default=_convert, check_circular=False,
+                           separators=(',', ':')).encode
+
+
+def encode_stream(documents, block_size=STREAM_BLOCK_SIZE):
+    """Generate a JSON list of documents, a block at a time
+
+    Each document is encoded as it is pulled from documents (i.e. a
+    mongo cursor), so the complete result is never held in memory.
+
+    """
+    block = ['[']
+    size = 0
+    separator = ''
+    for document in documents:
+        encoded = _encode(document)
+        block.append(separator)
+        block.append(encoded)
+        separator = ','
+        size += len(encoded)
+        if size >= block_size:
+            yield ''.join(block).encode('utf-8')
+            block = []
+            size = 0
+    block.append(']')
+    yield ''.join(block).encode('utf-8')
+
+
+def streaming_json_renderer(info):
+    """Renderer factory, streaming iterable results as JSON
+
+    Lists, dictionaries and strings are encoded at once, as with the
+    'json' renderer.  Any other iterable, such as a cursor, is encoded
+    incrementally as the response is sent.
+
+    """
+    def _render(value, system):
+        request = system.get('request')
+        response = request.response if request is not None else None
+        if response is not None and\
+                response.content_type == response.default_content_type:
+            response.content_type = 'application/json'
+        if isinstance(value, (dict, list, string_types)) or\
+                not hasattr(value, '__iter__') or response is None:
+            return _encode(value)
+        response.app_iter = encode_stream(value)
+        response.content_length = None
+        return None
+    return _render
+
 #class MongoEncoder(json.JSONEncoder):
 #    def default(self, obj, **kwargs):
 #        if isinstance(obj, ObjectId):
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from gridfs import GridFS
+import logging
+
+from pyramid.settings import asbool, aslist
+
+DEFAULT_BUCKET = 'fs'
+
+_registry = OrderedDict()
+
+
+class ReportType(object):
+    """Traversal and storage details for a type of report
+
+    :param name: the report_type, also the first traversal segment
+    :param factory: callable(request, key) returning the traversal
+      context for the type
+    :param bucket: the GridFS namespace ('<bucket>.files' and
+      '<bucket>.chunks') documents of this type are stored in
+    :param chunk_size: GridFS chunk size for new documents, None for
+      the GridFS default
+    :param compression: default compression applied on upload when
+      the client doesn't specify 'compress_with'
+    :param prefix: additional traversal segments starting with prefix
+      also match this type (i.e. 'essence_pc' for 'essence_pcE')
+    :param header: documents are CSV style, with a header row naming
+      the columns, which isn't counted as a record
+
+    """
+    def __init__(self, name, factory, bucket=DEFAULT_BUCKET,
+                 chunk_size=None, compression=None, prefix=None,
+                 header=False):
+        self.name = name
+        self.factory = factory
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.prefix = prefix
+        self.header = header
+
+    def __repr__(self):
+        return "<ReportType %s in '%s'>" % (self.name, self.bucket)
+
+    def matches(self, key):
+        return key == self.name or\
+            (self.prefix is not None and key.startswith(self.prefix))
+
+    def context(self, request, key):
+        """Return the traversal context for the matched segment key"""
+        return self.factory(request, key)
+
+
+def register(report_type):
+    """Add (or replace) a report type in the registry"""
+    _registry[report_type.name] = report_type
+
+
+def get(name):
+    """Return the named ReportType, or None if not registered"""
+    return _registry.get(name)
+
+
+def lookup(key):
+    """Return the ReportType matching traversal segment key, or None"""
+    for report_type in _registry.values():
+        if report_type.matches(key):
+            return report_type
+    return None
+
+
+def bucket_name(name):
+    """Return the GridFS bucket holding documents of the named type"""
+    report_type = get(name)
+    return report_type.bucket if report_type else DEFAULT_BUCKET
+
+
+def bucket_names():
+    """Return all GridFS buckets in use, the default bucket first"""
+    names = [DEFAULT_BUCKET]
+    for report_type in _registry.values():
+        if report_type.bucket not in names:
+            names.append(report_type.bucket)
+    return names
+
+
+def configure(settings, factory):
+    """Register and adjust report types from configuration
+
+    New report types, named in the `report_types` setting, are
+    registered with the given context factory.  Storage details of any
+    type, new or built in, may be set via `report_type.<name>.bucket`,
+    `report_type.<name>.chunk_size`, `report_type.<name>.compression`
+    and `report_type.<name>.header` i.e.::
+
+        report_types = syndromic
+        report_type.syndromic.compression = gzip
+        report_type.syndromic.header = true
+        report_type.longitudinal.bucket = longitudinal
+        report_type.longitudinal.chunk_size = 1048576
+
+    """
+    for name in aslist(settings.get('report_types', '')):
+        if get(name) is None:
+            register(ReportType(name, factory))
+    for report_type in _registry.values():
+        prefix = 'report_type.%s.' % report_type.name
+        if prefix + 'bucket' in settings:
+            report_type.bucket = settings[prefix + 'bucket']
+        if prefix + 'chunk_size' in settings:
+            report_type.chunk_size = int(settings[prefix + 'chunk_size'])
+        if prefix + 'compression' in settings:
+            report_type.compression = settings[prefix + 'compression'] or\
+                None
+        if prefix + 'header' in settings:
+            report_type.header = asbool(settings[prefix + 'header'])
+        logging.debug("configured %r", report_type)
+
+
+class Bucket(object):
+    """A GridFS namespace, with aliases for both its collections"""
+    def __init__(self, db, name):
+        self.name = name
+        self.fs = GridFS(db, collection=name)
+        self.files = db[name + '.files']
+        self.chunks = db[name + '.chunks']
+
+
+class Buckets(object):
+    """The GridFS buckets of a database, created on first use"""
+    def __init__(self, db):
+        self.db = db
+        self._buckets = {}
+
+    def get(self, name=DEFAULT_BUCKET):
+        if name not in self._buckets:
+            self._buckets[name] = Bucket(self.db, name)
+        return self._buckets[name]
+
+    def for_type(self, report_type):
+        """Return the bucket holding documents of report_type"""
+        return self.get(bucket_name(report_type))
+
+    def all(self):
+        return [self.get(name) for name in bucket_names()]
+
+    def locate(self, oid, report_type=None):
+        """Find document oid, returning a (bucket, document) tuple
+
+        Only the bucket for report_type is checked when given,
+        otherwise every bucket.  The tuple is (None, None) when the
+        document isn't found.
+
+        """
+        if report_type is not None:
+            candidates = [self.for_type(report_type)]
+        else:
+            candidates = self.all()
+        for bucket in candidates:
+            document = bucket.files.find_one(oid)
+            if document is not None:
+                return bucket, document
+        return None, None
@@ -1,7 +1,9 @@
 from bson.objectid import ObjectId
 from datetime import datetime
+import itertools
 import logging
 import os
+import pymongo
 from pyramid.exceptions import NotFound
 import re
 import requests
@@ -9,6 +11,275 @@ import requests
 from pheme.util.config import Config
 from pheme.util.util import inProduction
 from pheme.util.compression import expand_file, zip_file
+from pheme.webAPI import report_types
+from pheme.webAPI.admission import charge
+from pheme.webAPI.delta import open_delta, rebase_dependents
+from pheme.webAPI.events import EVENT_ATTRIBUTES, latest_event_id
+from pheme.webAPI.events import record_event
+from pheme.webAPI.export import Member, content_length, expand_stream
+from pheme.webAPI.export import expanded_name
+from pheme.webAPI.memory import tag_document
+from pheme.webAPI.metrics import aggregate
+from pheme.webAPI.packs import open_archived
+
+# Metadata telling apart reports uploaded under the same filename
+IDENTITY_FIELDS = ('reportable_region', 'patient_class', 'include_updates')
+
+
+def open_stored(fs, document):
+    """Return a file-like object for the stored bytes of a document
+
+    Hides the storage details, such as delta encoding or archival,
+    from callers.
+    The content is as persisted, compressed if the document was.
+
+    :param fs: the GridFS instance holding the document
+    :param document: the 'fs.files' document to open
+
+    """
+    if document.get('archive'):
+        return open_archived(document['archive'], document.get('filename'))
+    if document.get('storage') == 'delta':
+        return open_delta(fs, document)
+    return fs.get(document['_id'])
+
+
+def document_content(request, document):
+    """Return the (expanded) contents of a stored document
+
+    Consults the optional content cache before reading the chunks
+    from GridFS, caching the expanded content on a miss.
+
+    :param request: the request object, providing `buckets` and
+      `content_cache` attributes
+    :param document: the 'fs.files' document to read, from the bucket
+      of its report_type
+
+    """
+    cache = getattr(request, 'content_cache', None)
+    oid = document['_id']
+    md5 = document.get('md5')
+    if cache is not None:
+        content = cache.get(oid, md5)
+        if content is not None:
+            return content
+
+    # the expanded content is held in memory, count it against the
+    # request's admission
+    length = document.get('uncompressed_length') or\
+        content_length(document)
+    tag_document(request, document, length)
+    charge(request, length)
+    bucket = request.buckets.for_type(document.get('report_type'))
+    content = open_stored(bucket.fs, document)
+    compression = document.get('compression')
+    if compression:
+        content = expand_file(fileobj=content,
+                              zip_protocol=compression)
+    content = content.read()
+
+    if cache is not None:
+        cache.put(oid, md5, content)
+    return content
+
+
+def invalidate_searches(request):
+    """Advance the search cache generation after any write
+
+    Must be called whenever documents are added, removed or altered,
+    so cached search results are not served stale.
+
+    """
+    cache = getattr(request, 'search_cache', None)
+    if cache is not None:
+        cache.bump()
+
+
+def read_buckets(request, view_class):
+    """Return the Buckets to read from for a class of read only view
+
+    Honors any read preference configured for view_class (one of
+    'search', 'listing', 'metadata' or 'stats'), otherwise the primary
+    request.buckets are returned.  Never use for writes.
+
+    """
+    router = getattr(request, 'read_router', None)
+    if router is not None:
+        buckets = router.buckets(view_class)
+        if buckets is not None:
+            return buckets
+    return request.buckets
+
+
+def purge_documents(bucket, oids):
+    """Remove documents and their chunks in bulk
+
+    Issues one remove against '<bucket>.files' and one against
+    '<bucket>.chunks' for the whole batch, rather than a round trip
+    per document as GridFS.delete() requires.  As with
+    GridFS.delete(), the metadata goes first so readers never find a
+    document missing its chunks.
+
+    :param bucket: the report_types.Bucket holding the documents
+    :param oids: list of document (Object) IDs to remove
+
+    Returns a (files, chunks) tuple with the count of each removed.
+
+    """
+    if not oids:
+        return 0, 0
+    # Preserve delta encoded versions depending on a removed snapshot
+    for base_id in bucket.files.find({
+            'delta_base': {'$in': oids},
+            '_id': {'$nin': oids}}).distinct('delta_base'):
+        rebase_dependents(bucket.fs, bucket.files, base_id, exclude=oids)
+    documents = list(bucket.files.find(
+        {'_id': {'$in': oids}},
+        fields=['report_type', 'filename', 'latest'] +
+        list(IDENTITY_FIELDS)))
+    files = bucket.files.remove({'_id': {'$in': oids}}, w=1)
+    chunks = bucket.chunks.remove({'files_id': {'$in': oids}}, w=1)
+    record_event(bucket.files.database, 'delete', documents)
+    # Promote successors to any latest versions removed
+    identities = {}
+    for doc in documents:
+        if doc.get('latest'):
+            identity = report_identity(doc['report_type'], doc['filename'],
+                                       doc)
+            identities[version_key(identity)] = identity
+    for identity in identities.values():
+        promote_latest(bucket.files, identity)
+    return files.get('n', 0), chunks.get('n', 0)
+
+
+def ensure_indexes(db):
+    """Create the indexes the views depend on, if not already present"""
+    for bucket in report_types.Buckets(db).all():
+        # Resolve the latest version of a report with a single lookup
+        bucket.files.ensure_index([('report_type', pymongo.ASCENDING),
+                                   ('filename', pymongo.ASCENDING),
+                                   ('latest', pymongo.ASCENDING),
+                                   ('version', pymongo.DESCENDING)])
+        # Find each type's expired documents, a batch at a time, for
+        # the retention sweeper
+        bucket.files.ensure_index([('report_type', pymongo.ASCENDING),
+                                   ('uploadDate', pymongo.ASCENDING)])
+        # Documents uploaded before a cutoff, oldest first, to archive
+        bucket.files.ensure_index('uploadDate')
+        # Find versions stored as deltas against a snapshot
+        bucket.files.ensure_index('delta_base', sparse=True)
+        # Search for identical content by the sha256 derived on upload
+        bucket.files.ensure_index('sha256', sparse=True)
+        # Latest transfer, and documents not yet sent by each agent.
+        # The latter aren't sparse, a sparse index can't serve the
+        # {'$exists': False} of not_transferred_by
+        bucket.files.ensure_index('transfer_date', sparse=True)
+        bucket.files.ensure_index('transfers.delivered', sparse=True)
+        indexes = bucket.files.index_information()
+        for agent in (PHINMS_Transfer, DistributeTransfer):
+            key = 'last_transfer.' + agent.name
+            if indexes.get(key + '_1', {}).get('sparse'):
+                bucket.files.drop_index(key + '_1')  # as once created
+            bucket.files.ensure_index(key)
+
+
+def report_identity(report_type, filename, attributes=None, partial=False):
+    """Return the criteria identifying a report, across its versions
+
+    Uploads sharing a report_type and filename are distinct reports,
+    each versioned on its own, when any of the IDENTITY_FIELDS differ.
+
+    :param attributes: the document, or upload metadata, holding the
+      identity fields
+    :param partial: only constrain the identity fields present in
+      attributes, as when looking up by filename.  Otherwise absent
+      fields match only documents lacking them.
+
+    """
+    attributes = attributes or {}
+    identity = {'report_type': report_type, 'filename': filename}
+    for k in IDENTITY_FIELDS:
+        if k in attributes or not partial:
+            identity[k] = attributes.get(k)
+    return identity
+
+
+def version_key(identity):
+    """Return the 'fs.versions' counter id for a report identity"""
+    key = '%s/%s' % (identity['report_type'], identity['filename'])
+    qualifiers = ['%s=%s' % (k, identity[k]) for k in IDENTITY_FIELDS
+                  if identity.get(k) is not None]
+    if qualifiers:
+        # reports without identity fields keep their original counter
+        key += '?' + '&'.join(qualifiers)
+    return key
+
+
+def next_version(db, identity):
+    """Atomically claim the next version number for a report
+
+    Version counters live in the 'fs.versions' collection, one per
+    report identity (see `report_identity`), so concurrent uploads of
+    the same report are always assigned distinct, increasing version
+    numbers.
+
+    """
+    counter = db['fs.versions'].find_and_modify(
+        query={'_id': version_key(identity)},
+        update={'$inc': {'version': 1}}, upsert=True, new=True)
+    return counter['version']
+
+
+def mark_latest(document_store, document_id, identity, version):
+    """Clear the latest flag on all versions older than version
+
+    Called after persisting a new version flagged as latest.  Only
+    older versions of the same report identity are cleared, so should
+    uploads race, the highest version remains latest.
+
+    """
+    document_store.update(dict(identity, latest=True,
+                               version={'$lt': version},
+                               _id={'$ne': document_id}),
+                          {'$set': {'latest': False}}, multi=True)
+
+
+def promote_latest(document_store, identity):
+    """Flag the newest remaining version as latest, after a delete"""
+    if document_store.find_one(dict(identity, latest=True)):
+        return
+    newest = document_store.find_one(dict(identity,
+                                          version={'$exists': True}),
+                                     sort=[('version', pymongo.DESCENDING)])
+    if newest:
+        document_store.update({'_id': newest['_id']},
+                              {'$set': {'latest': True}})
+
+
+def find_latest(document_store, identity):
+    """Return the latest version of the identified report, or None
+
+    Versioned documents resolve with one indexed lookup on the latest
+    flag.  Given a partial identity, several reports may match, the
+    most recently uploaded latest version wins.  Documents uploaded
+    before versioning fall back to the most recent upload.
+
+    """
+    sort = [('uploadDate', pymongo.DESCENDING)]
+    document = document_store.find_one(dict(identity, latest=True),
+                                       sort=sort)
+    if document is None:
+        document = document_store.find_one(identity, sort=sort)
+    return document
+
+
+def forget_documents(request, oids):
+    """Drop cached state for documents removed from the store"""
+    cache = getattr(request, 'content_cache', None)
+    if cache is not None:
+        for oid in oids:
+            cache.invalidate(oid)
+    invalidate_searches(request)
 
 
 class Root(object):
@@ -23,19 +294,28 @@ class Root(object):
         respective classes.
 
         """
-        if key.startswith('essence'):
-            return EssenceReport(self.request, key)
-        elif key == 'longitudinal':
-            return LongitudinalReport(self.request)
-        elif key == 'phin-ms':
+        if key == PHINMS_Transfer.name:
             return PHINMS_Transfer(self.request)
-        elif key == 'distribute':
+        elif key == DistributeTransfer.name:
             return DistributeTransfer(self.request)
         elif key == 'search':
             return Search(self.request)
-        else:
-            # With no recognizable path, try BaseReport as context
-            return BaseReport(self.request).__getitem__(key)
+        elif key == 'retention':
+            return Retention(self.request)
+        elif key == 'changes':
+            return ChangeFeed(self.request)
+        elif key == 'memory':
+            return MemoryReport(self.request)
+        elif key == 'metrics':
+            return Metrics(self.request)
+
+        # Report types, built in and configured, are in the registry
+        report_type = report_types.lookup(key)
+        if report_type is not None:
+            return report_type.context(self.request, key)
+
+        # With no recognizable path, try BaseReport as context
+        return BaseReport(self.request).__getitem__(key)
 
 
 class TransferAgent(object):
@@ -46,6 +326,12 @@ class TransferAgent(object):
     pulling the document id during traversal.
 
     """
+    # traversal segment naming the agent, recorded with each transfer
+    name = None
+
+    # number of transfers retained in each document's history
+    history_size = 20
+
     def __init__(self, request=None):
         self.request = request
 
@@ -68,12 +354,13 @@ class TransferAgent(object):
             self.document_id = ObjectId(key)
         except:
             raise NotFound
-        if not self.request.fs.exists(self.document_id):
+        self.bucket, self.document = self.request.buckets.\
+            locate(self.document_id)
+        if self.document is None:
             logging.error("Can't transfer non existent document_id "
                           "'%s'", self.document_id)
             raise NotFound
-        self.content = self.request.fs.get(self.document_id)
-        self.document = self.request.document_store.find_one(self.document_id)
+        self.content = open_stored(self.bucket.fs, self.document)
         return self
 
     def extract_content(self, compress_with):
@@ -86,11 +373,33 @@ class TransferAgent(object):
                                zip_protocol=compress_with)
         return content
 
-    def record_transfer(self):
-        # retain transfer metadata
-        self.document['transfer_date'] = datetime.utcnow()
-        self.document['transfer_agent'] = str(self.__class__)
-        self.request.document_store.save(self.document)
+    def already_sent(self):
+        """True if this agent has previously transferred the document"""
+        return self.name in self.document.get('last_transfer', {})
+
+    def record_transfer(self, **details):
+        """Retain transfer metadata, via an atomic partial update
+
+        Sets the latest transfer date and agent, the per agent
+        `last_transfer.<agent>` date, and pushes an entry onto the
+        `transfers` history, bounded to the most recent
+        `history_size` entries.  Other metadata is left untouched,
+        avoiding a race with concurrent changes to the document.
+
+        :param details: additional values to record in the history entry
+
+        """
+        now = datetime.utcnow()
+        entry = dict(details, agent=self.name, date=now)
+        self.bucket.files.update(
+            {'_id': self.document_id},
+            {'$set': {'transfer_date': now,
+                      'transfer_agent': str(self.__class__),
+                      'last_transfer.' + self.name: now},
+             '$push': {'transfers': {'$each': [entry],
+                                     '$slice': -self.history_size}}})
+        record_event(self.bucket.files.database, 'transfer', [self.document])
+        invalidate_searches(self.request)
 
 
 class PHINMS_Transfer(TransferAgent):
@@ -113,6 +422,8 @@ class PHINMS_Transfer(TransferAgent):
     longitudinal=/opt/phin-ms/shared/longitudinal/outgoing/
 
     """
+    name = 'phin-ms'
+
     def __init__(self, request):
         super(PHINMS_Transfer, self).__init__(request)
         self._outbound_dir = None
@@ -133,7 +444,8 @@ class PHINMS_Transfer(TransferAgent):
 
         Copy the file into the directory PHIN-MS is configured to
         poll.  NB - this method is doing nothing to confirm it is
-        sent, that is left to the watchdog.
+        sent, the transfer is recorded as undelivered until the
+        DeliveryWatcher sees PHIN-MS consume the file.
 
         :param compress_with: if document isn't already compressed and
           this is set, compress the file before transfering.
@@ -142,14 +454,14 @@ class PHINMS_Transfer(TransferAgent):
         self._set_report_type(self.document.get('report_type', None),
                               self.document.get('patient_class', None))
         filename = self.document['filename']
-        dest = os.path.join(self.outbound_dir, filename)
+        dest = os.path.normpath(os.path.join(self.outbound_dir, filename))
         content = self.extract_content(compress_with)
 
         if inProduction():
             logging.info("write %s to %s" % (filename, dest))
             with open(dest, 'wb') as destination:
                 destination.write(content.read())
-            self.record_transfer()
+            self.record_transfer(path=dest, delivered=False)
         else:
             logging.warn("inProduction() check failed, not sending "
                          "file '%s' to '%s'", filename, dest)
@@ -161,6 +473,8 @@ class DistributeTransfer(TransferAgent):
     Used to upload files to Distribute's https server.
 
     """
+    name = 'distribute'
+
     def __init__(self, request):
         super(DistributeTransfer, self).__init__(request)
 
@@ -225,10 +539,36 @@ class BaseReport(object):
         for k, v in self.__persist_attributes.items():
             yield k, v
 
+    @property
+    def bucket(self):
+        """The GridFS bucket for this context's report_type"""
+        return self.request.buckets.for_type(self.report_type)
+
+    def locate(self, oid, buckets=None):
+        """Find document oid, returning a (bucket, document) tuple
+
+        Limited to the bucket of this context's report_type, if any.
+
+        :param buckets: the Buckets to search, defaults to the
+          primary request.buckets
+
+        """
+        buckets = buckets or self.request.buckets
+        return buckets.locate(oid, getattr(self, 'report_type', None))
+
     def delete(self):
         """Delete this report from the backing datastore"""
         try:
-            self.request.fs.delete(ObjectId(self.filename))
+            oid = ObjectId(self.filename)
+            bucket, document = self.locate(oid)
+            rebase_dependents(bucket.fs, bucket.files, oid)
+            bucket.fs.delete(oid)
+            record_event(bucket.files.database, 'delete', [document])
+            forget_documents(self.request, [oid])
+            if document.get('latest'):
+                promote_latest(bucket.files, report_identity(
+                    document['report_type'], document['filename'],
+                    document))
             logging.info("Deleted report %s", self.filename)
             return self.filename
         except:
@@ -252,6 +592,43 @@ class BaseReport(object):
         self.filename = key
         return self
 
+    def identity(self, attributes=None):
+        """Return the (partial) report_identity this context names
+
+        Identity fields come from the context's save attributes (i.e.
+        the patient class of 'essence_pcE'), then attributes.
+
+        """
+        named = dict(self.additional_save_attributes())
+        named.update(attributes or {})
+        return report_identity(self.report_type, self.filename, named,
+                               partial=True)
+
+    def versions(self, attributes=None):
+        """Return metadata for each version of this report, newest first
+
+        Versions of every report sharing the filename are listed,
+        unless narrowed by the identity fields in attributes.  Each
+        entry carries its identity fields, telling the reports apart.
+
+        """
+        bucket = read_buckets(self.request, 'listing').\
+            for_type(self.report_type)
+        cursor = bucket.files.find(
+            self.identity(attributes),
+            fields=['version', 'latest', 'uploadDate', 'length'] +
+            list(IDENTITY_FIELDS))
+        versions = []
+        for doc in cursor.sort('uploadDate', pymongo.DESCENDING):
+            version = dict((k, doc[k]) for k in IDENTITY_FIELDS if k in doc)
+            version.update({'id': doc['_id'],
+                            'version': doc.get('version'),
+                            'latest': doc.get('latest', False),
+                            'uploadDate': doc['uploadDate'],
+                            'length': doc['length']})
+            versions.append(version)
+        return versions
+
 
 class EssenceReport(BaseReport):
     """Traversal context for essence reports"""
@@ -286,6 +663,19 @@ class LongitudinalReport(BaseReport):
         super(LongitudinalReport, self).__init__(request)
 
 
+class ConfiguredReport(BaseReport):
+    """Traversal context for report types added via configuration"""
+    def __init__(self, request=None, key=None):
+        super(ConfiguredReport, self).__init__(request)
+        self.report_type = key
+
+
+report_types.register(report_types.ReportType(
+    'essence', EssenceReport, prefix='essence_pc', header=True))
+report_types.register(report_types.ReportType(
+    'longitudinal', lambda request, key: LongitudinalReport(request)))
+
+
 class Search(object):
     """Search context - look up existing documents"""
     def __init__(self, request=None):
@@ -297,6 +687,12 @@ class Search(object):
         # should define search terms
         raise KeyError
 
+    @staticmethod
+    def not_transferred_by(criteria, agent):
+        """Narrow criteria to documents agent has yet to transfer"""
+        return dict(criteria, **{'last_transfer.' + agent:
+                                 {'$exists': False}})
+
     def search(self, criteria, limit=0):
         """Search for documents matching criteria
 
@@ -304,22 +700,296 @@ class Search(object):
         :param limit: curtail lenght of result set
 
         Returns empty string on no match, document contents on
-        a perfect match or with limit=1, and a list of document
-        meta-data on multiple matches.
+        a perfect match or with limit=1, and an iterable of document
+        meta-data on multiple matches.  Unless cached, the iterable
+        reads from the cursor as it goes, for the 'json_stream'
+        renderer.  Only misses and meta-data lists of at most
+        `max_documents`, read from the primary, are held in the search
+        cache.
 
         """
-        cursor = self.request.document_store.find(criteria).limit(limit)
-        count = cursor.count(with_limit_and_skip=True)
-        if count == 0:
+        cache = getattr(self.request, 'search_cache', None)
+        buckets = read_buckets(self.request, 'search')
+        if buckets is not self.request.buckets:
+            # reads from a lagging secondary, cached under the current
+            # generation, would outlive max_staleness
+            cache = None
+        if cache is not None:
+            if cache.shared:
+                # writes by other worker processes show in the event log
+                cache.sync(latest_event_id(self.request.db))
+            key = cache.key(criteria, limit)
+            generation = cache.generation
+            hit, result = cache.get(key)
+            if hit:
+                return result
+            result = self._search(criteria, limit, buckets)
+            if isinstance(result, itertools.chain):
+                # cached results can't be cursors, but only small ones
+                # are worth holding in memory
+                head = list(itertools.islice(result,
+                                             cache.max_documents + 1))
+                if len(head) > cache.max_documents:
+                    return itertools.chain(head, result)
+                result = head
+            elif result:
+                # a single match's content, the byte bounded content
+                # cache holds it where it fits
+                return result
+            cache.put(key, result, generation)
+            return result
+        return self._search(criteria, limit, buckets)
+
+    def buckets(self, criteria, buckets=None):
+        """Return the buckets that may hold documents matching criteria
+
+        A plain report_type criterion narrows the search to that
+        type's bucket, otherwise all buckets are searched.
+
+        :param buckets: the Buckets to choose from, defaults to the
+          primary request.buckets
+
+        """
+        buckets = buckets or self.request.buckets
+        report_type = criteria.get('report_type')
+        if report_type and not isinstance(report_type, dict):
+            return [buckets.for_type(report_type)]
+        return buckets.all()
+
+    def _search(self, criteria, limit, buckets):
+        documents = self._documents(criteria, limit, buckets)
+        first = list(itertools.islice(documents, 2))
+        if not first:
             return ''
-        elif count == 1:
+        elif len(first) == 1:
             # with a single document, return contents
-            document = cursor.next()
-            content = self.request.fs.get(document.get('_id'))
-            compression = document.get('compression')
-            if compression:
-                content = expand_file(fileobj=content,
-                                      zip_protocol=compression)
-            return content.read()
-
-        return [doc for doc in cursor]
+            return document_content(self.request, first[0])
+
+        # the remaining documents are left on the cursor, for the
+        # renderer to stream
+        return itertools.chain(first, documents)
+
+    def _documents(self, criteria, limit, buckets):
+        """Generate the documents matching criteria, up to limit"""
+        found = 0
+        for bucket in self.buckets(criteria, buckets):
+            remaining = limit - found if limit else 0
+            for document in bucket.files.find(criteria).limit(remaining):
+                found += 1
+                yield document
+            if limit and found >= limit:
+                break
+
+    def bulk_delete(self, criteria, batch_size=500):
+        """Delete all documents matching criteria, in batches
+
+        :param criteria: dictionary defining search terms
+        :param batch_size: maximum documents removed per round trip
+
+        Generator, yielding running (files, chunks) totals removed
+        after each batch.
+
+        """
+        files = chunks = 0
+        for bucket in self.buckets(criteria):
+            while True:
+                oids = [doc['_id'] for doc in bucket.files.
+                        find(criteria, fields=['_id']).limit(batch_size)]
+                if not oids:
+                    break
+                removed = purge_documents(bucket, oids)
+                forget_documents(self.request, oids)
+                files += removed[0]
+                chunks += removed[1]
+                logging.info("bulk delete removed %d documents from %s",
+                             removed[0], bucket.name)
+                yield files, chunks
+
+    def metadata(self, oids, fields=None, report_type=None):
+        """Return metadata for many documents, in the order requested
+
+        A single `$in` query per bucket, stopping once every document
+        is found.  Unknown ids are left out of the result.
+
+        :param oids: the document ObjectIds to fetch
+        :param fields: optional list of metadata fields to return,
+          `_id` is always included
+        :param report_type: optionally limit to this type's bucket
+
+        """
+        buckets = read_buckets(self.request, 'metadata')
+        found = {}
+        for bucket in self.buckets({'report_type': report_type}, buckets):
+            remaining = [oid for oid in oids if oid not in found]
+            if not remaining:
+                break
+            for document in bucket.files.find({'_id': {'$in': remaining}},
+                                              fields=fields):
+                found[document['_id']] = document
+        return [found[oid] for oid in oids if oid in found]
+
+    def export(self, criteria, expand=False):
+        """Generate an archive Member for each document matching criteria
+
+        Documents are visited via cursors, one bucket at a time,
+        newest first by the _id index (a sort on any other field
+        would be done in memory, and fail on large results), and each
+        member's content is only opened as the archive reaches it.
+        Members are named `<report_type>/<filename>`, with the
+        document id prefixed to the filename of any repeats (i.e.
+        earlier versions).
+
+        :param criteria: dictionary defining search terms
+        :param expand: decompress compressed documents, otherwise
+          members hold the content as stored
+
+        """
+        seen = set()
+        for bucket in self.buckets(criteria,
+                                   read_buckets(self.request, 'search')):
+            cursor = bucket.files.find(criteria).sort(
+                '_id', pymongo.DESCENDING)
+            for document in cursor:
+                filename = document.get('filename') or str(document['_id'])
+                compression = document.get('compression')
+                if expand:
+                    filename = expanded_name(filename, compression)
+                name = '%s/%s' % (document.get('report_type', bucket.name),
+                                  filename)
+                if name in seen:
+                    name = '%s/%s-%s' % (document.get('report_type',
+                                                      bucket.name),
+                                         document['_id'], filename)
+                seen.add(name)
+
+                def open(fs=bucket.fs, document=document):
+                    stored = open_stored(fs, document)
+                    return expand_stream(stored, compression if expand
+                                         else None)
+
+                if expand and compression:
+                    # known when derived at upload, else measured
+                    size = document.get('uncompressed_length')
+                else:
+                    size = content_length(document)
+                yield Member(name, document['uploadDate'], open, size)
+
+    def bulk_update(self, criteria, update):
+        """Apply update to the metadata of all documents matching criteria
+
+        :param criteria: dictionary defining search terms
+        :param update: the `$set` and/or `$unset` update to apply
+
+        A single multi document update per bucket.  Each updated
+        document gets an 'update' event, carrying its new attributes.
+        Returns the (matched, modified) document counts.
+
+        """
+        matched = modified = 0
+        for bucket in self.buckets(criteria):
+            # note the documents for the change feed, the criteria may
+            # no longer match once updated
+            documents = list(bucket.files.find(
+                criteria, fields=EVENT_ATTRIBUTES))
+            if not documents:
+                continue
+            result = bucket.files.update(criteria, update, multi=True, w=1)
+            matched += result.get('n', 0)
+            modified += result.get('nModified', result.get('n', 0))
+            for document in documents:
+                document.update(update.get('$set', {}))
+                for field in update.get('$unset', {}):
+                    document.pop(field, None)
+            record_event(bucket.files.database, 'update', documents)
+        invalidate_searches(self.request)
+        return matched, modified
+
+    def count(self, criteria):
+        """Return the number of documents matching criteria"""
+        return sum(bucket.files.find(criteria).count()
+                   for bucket in self.buckets(criteria))
+
+
+class Retention(object):
+    """Retention context - report on the configured retention rules"""
+    def __init__(self, request=None):
+        self.request = request
+
+    def __getitem__(self, key):
+        """Traversal method"""
+        raise KeyError
+
+    def dry_run(self):
+        """Report what the retention sweeper would remove right now
+
+        Returns a list with an entry for each configured rule,
+        including the cutoff date and number of expired documents.
+
+        """
+        rules = self.request.registry.settings.get('retention_rules', [])
+        now = datetime.utcnow()
+        report = []
+        for rule in rules:
+            criteria = rule.criteria(rules, now)
+            report.append({'report_type': rule.report_type,
+                           'patient_class': rule.patient_class,
+                           'days': rule.days,
+                           'cutoff': criteria['uploadDate']['$lt'],
+                           'expired': read_buckets(self.request, 'stats').
+                           for_type(rule.report_type).files.
+                           find(criteria).count()})
+        return report
+
+
+class ChangeFeed(object):
+    """Change feed context - follow document change events"""
+    def __init__(self, request=None):
+        self.request = request
+
+    def __getitem__(self, key):
+        """Traversal method"""
+        raise KeyError
+
+
+class MemoryReport(object):
+    """Memory report context - requests with the highest memory peaks"""
+    def __init__(self, request=None):
+        self.request = request
+
+    def __getitem__(self, key):
+        """Traversal method"""
+        raise KeyError
+
+    def worst(self, limit=20):
+        """Return the recent requests which grew memory the most
+
+        Raises NotFound unless memory profiling is enabled.
+
+        """
+        monitor = self.request.registry.settings.get('memory_monitor')
+        if monitor is None:
+            raise NotFound
+        return monitor.worst(limit)
+
+
+class Metrics(object):
+    """Metrics context - request metrics summed over all workers"""
+    def __init__(self, request=None):
+        self.request = request
+
+    def __getitem__(self, key):
+        """Traversal method"""
+        raise KeyError
+
+    def aggregate(self):
+        """Return the metrics of all workers publishing recently
+
+        Raises NotFound unless metrics are enabled.
+
+        """
+        settings = self.request.registry.settings
+        if settings.get('metrics') is None:
+            raise NotFound
+        # allow a worker to miss a couple of publishing intervals
+        max_age = 3 * float(settings['metrics.interval'])
+        return aggregate(self.request.db, max_age)
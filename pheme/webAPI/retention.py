@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+
+from pheme.webAPI.report_types import Buckets
+from pheme.webAPI.resources import purge_documents
+
+
+class RetentionRule(object):
+    """Retention period for a report_type, optionally by patient_class
+
+    A rule naming a patient_class takes precedence over the rule for
+    the whole report_type, for documents of that patient class.
+
+    """
+    def __init__(self, report_type, days, patient_class=None):
+        self.report_type = report_type
+        self.patient_class = patient_class
+        self.days = days
+
+    def __repr__(self):
+        return "<RetentionRule %s:%s %d days>" % (
+            self.report_type, self.patient_class, self.days)
+
+    def criteria(self, rules, now=None):
+        """Query matching the documents this rule expires
+
+        :param rules: all configured rules, so a report_type wide
+          rule can defer to any more specific patient_class rules
+        :param now: reference time, defaults to utcnow()
+
+        """
+        now = now or datetime.utcnow()
+        criteria = {'report_type': self.report_type,
+                    'uploadDate': {'$lt': now - timedelta(days=self.days)}}
+        if self.patient_class:
+            criteria['patient_class'] = self.patient_class
+        else:
+            specific = [r.patient_class for r in rules
+                        if r.report_type == self.report_type and
+                        r.patient_class]
+            if specific:
+                criteria['patient_class'] = {'$nin': specific}
+        return criteria
+
+
+def parse_rules(value):
+    """Parse retention rules from the `retention.rules` setting
+
+    One rule per line, naming the report_type (with an optional
+    patient_class following a colon) and the number of days to keep
+    matching documents, i.e.::
+
+        retention.rules =
+            essence 400
+            essence:E 180
+            longitudinal 730
+
+    """
+    rules = []
+    for line in (value or '').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            target, days = line.split()
+            days = int(days)
+        except ValueError:
+            raise ValueError("invalid retention rule '%s'" % line)
+        report_type, _, patient_class = target.partition(':')
+        rules.append(RetentionRule(report_type, days,
+                                   patient_class or None))
+    return rules
+
+
+class RetentionSweeper(threading.Thread):
+    """Background thread deleting documents past their retention
+
+    Each pass walks the configured rules, removing expired documents
+    and their chunks in batches of `batch_size`.  The sweeper sleeps
+    `batch_pause` seconds between batches so a large backlog of
+    expired documents doesn't starve foreground requests.
+
+    """
+    def __init__(self, settings, rules, interval, batch_size=100,
+                 batch_pause=1.0):
+        super(RetentionSweeper, self).__init__(name='RetentionSweeper')
+        self.daemon = True
+        self.settings = settings
+        self.rules = rules
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._stop_event = threading.Event()
+
+    @property
+    def buckets(self):
+        return Buckets(self.settings['db_conn'][self.settings['db_name']])
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("retention sweep failed")
+            self._stop_event.wait(self.interval)
+
+    def sweep(self):
+        """Run a single pass over all rules, returning count removed"""
+        removed = 0
+        buckets = self.buckets
+        for rule in self.rules:
+            criteria = rule.criteria(self.rules)
+            bucket = buckets.for_type(rule.report_type)
+            while not self._stop_event.is_set():
+                oids = [doc['_id'] for doc in bucket.files.
+                        find(criteria, fields=['_id']).
+                        limit(self.batch_size)]
+                if not oids:
+                    break
+                self.purge(bucket, oids)
+                removed += len(oids)
+                logging.info("retention %r removed %d documents",
+                             rule, len(oids))
+                time.sleep(self.batch_pause)
+        return removed
+
+    def purge(self, bucket, oids):
+        purge_documents(bucket, oids)
+        content_cache = self.settings.get('content_cache')
+        if content_cache is not None:
+            for oid in oids:
+                content_cache.invalidate(oid)
+        search_cache = self.settings.get('search_cache')
+        if search_cache is not None:
+            search_cache.bump()
@@ -0,0 +1,107 @@
+from datetime import timedelta
+import logging
+import threading
+import time
+
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import ReadPreference
+
+from pheme.webAPI.report_types import Buckets
+
+# Classes of read only views which may be routed away from the primary
+VIEW_CLASSES = ('search', 'listing', 'metadata', 'stats')
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+
+def parse_preferences(settings):
+    """Return the configured read preference for each view class
+
+    Read from the `read_preference.<view class>` settings, i.e.::
+
+        read_preference.search = secondaryPreferred
+
+    View classes without a setting (or set to 'primary') are left
+    out, and always read from the primary.
+
+    """
+    preferences = {}
+    for view_class in VIEW_CLASSES:
+        name = settings.get('read_preference.' + view_class, 'primary')
+        try:
+            preference = READ_PREFERENCES[name]
+        except KeyError:
+            raise ValueError("unknown read preference '%s' for %s" %
+                             (name, view_class))
+        if preference != ReadPreference.PRIMARY:
+            preferences[view_class] = preference
+    return preferences
+
+
+class ReadRouter(object):
+    """Route read only views to replica set secondaries
+
+    Each view class may be given its own read preference.  Secondary
+    reads are only permitted while replication lag is within
+    `max_staleness` seconds; beyond that, or should the lag be
+    unknown (i.e. a standalone mongod), reads fall back to the
+    primary.  Lag is checked via replSetGetStatus at most every
+    `check_interval` seconds.
+
+    Writes (uploads, deletes, transfer bookkeeping) never use the
+    router, and always go to the primary.
+
+    """
+    def __init__(self, connection, db_name, preferences, max_staleness,
+                 check_interval=10):
+        self.connection = connection
+        self.db_name = db_name
+        self.preferences = preferences
+        self.max_staleness = timedelta(seconds=max_staleness)
+        self.check_interval = check_interval
+        self._lag = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def lag(self):
+        """Return the worst secondary replication lag, None if unknown"""
+        with self._lock:
+            if time.time() - self._checked > self.check_interval:
+                self._lag = self._measure_lag()
+                self._checked = time.time()
+            return self._lag
+
+    def _measure_lag(self):
+        try:
+            status = self.connection.admin.command('replSetGetStatus')
+        except PyMongoError as e:
+            logging.debug("no replica set status, reads use primary: %s",
+                          e)
+            return None
+        primary = [m['optimeDate'] for m in status['members']
+                   if m['stateStr'] == 'PRIMARY']
+        secondaries = [m['optimeDate'] for m in status['members']
+                       if m['stateStr'] == 'SECONDARY']
+        if not primary or not secondaries:
+            return None
+        return primary[0] - min(secondaries)
+
+    def buckets(self, view_class):
+        """Return Buckets for view_class reads, or None for the primary"""
+        preference = self.preferences.get(view_class)
+        if preference is None:
+            return None
+        lag = self.lag()
+        if lag is None or lag > self.max_staleness:
+            logging.debug("replication lag %s, %s reads use primary",
+                          lag, view_class)
+            return None
+        db = self.connection[self.db_name]
+        db.read_preference = preference
+        return Buckets(db)
@@ -0,0 +1,155 @@
+"""Serve the application from multiple worker processes
+
+Compression, JSON and template rendering are CPU bound, so a single
+process is limited to one core by the GIL.  `pheme_serve` loads the
+application once, binds the listening socket, then forks a waitress
+server per worker, all accepting from the shared socket.
+
+The mongo client is created afresh in each worker on first use (see
+`pheme.webAPI.connection.ForkSafeClient`), caches and the per request
+instrumentation are per worker, and background tasks which must only
+run once (retention sweeper, PHIN-MS delivery watcher) only run in
+the first worker.  Workers exiting unexpectedly are replaced.
+
+"""
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+try:
+    from ConfigParser import SafeConfigParser as ConfigParser
+except ImportError:  # python 3
+    from configparser import ConfigParser
+
+from pyramid.paster import get_appsettings, setup_logging
+import waitress
+
+from pheme.webAPI import main as make_app
+from pheme.webAPI import start_worker
+
+
+class Arbiter(object):
+    """Fork and supervise the worker processes
+
+    :param app: the WSGI application, loaded in prefork mode
+    :param sock: the bound, listening socket shared by all workers
+    :param workers: number of worker processes
+    :param threads: waitress threads within each worker
+
+    """
+    def __init__(self, app, sock, workers, threads):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.threads = threads
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        """Fork worker index, returning its pid in the arbiter"""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return pid
+
+        # in the worker, never return to the arbiter's loop
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            start_worker(self.app.registry.settings, primary=index == 0)
+            logging.info("worker %d serving, pid %d", index, os.getpid())
+            waitress.serve(self.app, sockets=[self.sock],
+                           threads=self.threads)
+        except Exception:
+            logging.exception("worker %d failed", index)
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass  # already gone
+
+    def run(self):
+        """Run the workers until signalled, replacing any that exit"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            logging.warning("worker %d (pid %d) exited with status %d, "
+                            "restarting", index, pid, status)
+            time.sleep(1)  # don't spin on a worker failing at startup
+            self.spawn(index)
+        logging.info("all workers stopped")
+
+
+def server_address(config_uri):
+    """Return the host and port of the file's [server:main] section"""
+    parser = ConfigParser()
+    parser.read(config_uri.split('#')[0])
+    host, port = '0.0.0.0', 6543
+    if parser.has_section('server:main'):
+        if parser.has_option('server:main', 'host'):
+            host = parser.get('server:main', 'host')
+        if parser.has_option('server:main', 'port'):
+            port = parser.getint('server:main', 'port')
+    return host, port
+
+
+def main():
+    """Serve the application from multiple worker processes, i.e.::
+
+        pheme_serve production.ini --workers 4
+
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('config_uri', help="initialization file")
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes, defaults to one per core")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="waitress threads per worker")
+    parser.add_argument('--host', help="defaults to [server:main] host")
+    parser.add_argument('--port', type=int,
+                        help="defaults to [server:main] port")
+    args = parser.parse_args()
+
+    setup_logging(args.config_uri)
+    host, port = server_address(args.config_uri)
+    host, port = args.host or host, args.port or port
+
+    settings = get_appsettings(args.config_uri)
+    settings.update({'prefork': 'true', 'workers': str(args.workers)})
+    app = make_app(settings.global_conf, **settings)
+    # main() used a client for its setup, don't share it with workers
+    app.registry.settings['db_conn'].disconnect()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    logging.info("serving on http://%s:%d with %d workers", host, port,
+                 args.workers)
+    Arbiter(app, sock, args.workers, args.threads).run()
@@ -1,5 +1,7 @@
 from bson.objectid import ObjectId
 import gzip
+import hashlib
+import itertools
 import re
 import os
 from datetime import datetime, timedelta
@@ -9,17 +11,45 @@ from gridfs import GridFS
 from gridfs.errors import NoFile
 import pymongo
 import requests
-from tempfile import NamedTemporaryFile
+import shutil
+import tarfile
+from tempfile import NamedTemporaryFile, mkdtemp
 import unittest
+import zipfile
 from pyramid import testing
 from pyramid.traversal import traverse
 
 from pheme.util.config import Config
 from pheme.util.util import inProduction
 from pheme.util.compression import expand_file, zip_file
+from pheme.webAPI import delta
+from pheme.webAPI import packs
+from pheme.webAPI import report_types
+from pheme.webAPI.archive import archive_document
+from pheme.webAPI.packs import PackStore
+from pheme.webAPI.renderers import encode_stream
+from pheme.webAPI.report_types import Bucket, Buckets
+from pheme.webAPI.admission import AdmissionController, Overloaded
+from pheme.webAPI.cache import ContentCache, SearchCache
+from pheme.webAPI.cache import canonical_criteria
+from pheme.webAPI import connection
+from pheme.webAPI.connection import ForkSafeClient
+from pheme.webAPI.metrics import WorkerMetrics
+from pheme.webAPI.delivery import DeliveryWatcher
+from pheme.webAPI.derived import DerivedMetadataReader
+from pheme.webAPI.events import ConsumerLimit, ReleasingIterable
+from pheme.webAPI.events import event_criteria, record_event
+from pheme.webAPI.memory import MemoryMonitor, tracemalloc
+from pheme.webAPI.export import Member, tar_stream, zip_stream
 from pheme.webAPI.resources import Root, BaseReport, EssenceReport
 from pheme.webAPI.resources import LongitudinalReport, Search
 from pheme.webAPI.resources import DistributeTransfer, PHINMS_Transfer
+from pheme.webAPI.resources import ConfiguredReport, Retention
+from pheme.webAPI.resources import find_latest, mark_latest
+from pheme.webAPI.resources import open_stored, purge_documents
+from pheme.webAPI.resources import report_identity, version_key
+from pheme.webAPI.retention import parse_rules
+from pheme.webAPI.routing import ReadRouter, parse_preferences
 
 
 def add_testdb_to_request(request):
@@ -229,6 +259,70 @@ class ReportTraversalTests(unittest.TestCase):
         self.assertTrue(isinstance(context, Search))
 
 
+class RetentionTests(unittest.TestCase):
+    """Unit test retention rule handling"""
+    def test_parse(self):
+        rules = parse_rules("\nessence 400\nessence:E 30\n")
+        self.assertEqual([(r.report_type, r.patient_class, r.days)
+                          for r in rules],
+                         [('essence', None, 400), ('essence', 'E', 30)])
+
+    def test_parse_invalid(self):
+        self.assertRaises(ValueError, parse_rules, "essence forever")
+
+    def test_specific_rule_precedence(self):
+        rules = parse_rules("essence 400\nessence:E 30\nlongitudinal 9")
+        now = datetime(2013, 7, 1)
+        criteria = rules[0].criteria(rules, now)
+        self.assertEqual(criteria['patient_class'], {'$nin': ['E']})
+        self.assertEqual(criteria['uploadDate']['$lt'],
+                         now - timedelta(days=400))
+        self.assertEqual(rules[1].criteria(rules, now)['patient_class'],
+                         'E')
+        self.assertFalse('patient_class' in rules[2].criteria(rules, now))
+
+    def test_retention_traversal(self):
+        root = Root(None)
+        self.assertTrue(isinstance(root['retention'], Retention))
+
+
+class ReportTypeRegistryTests(unittest.TestCase):
+    """Unit test report type registration and configuration"""
+    def tearDown(self):
+        report_types._registry.pop('syndromic', None)
+        report_types.get('longitudinal').bucket = report_types.DEFAULT_BUCKET
+        report_types.get('longitudinal').chunk_size = None
+
+    def test_builtin_lookup(self):
+        self.assertEqual(report_types.lookup('essence_pcE').name, 'essence')
+        self.assertEqual(report_types.lookup('longitudinal').name,
+                         'longitudinal')
+        self.assertEqual(report_types.lookup('unknown'), None)
+
+    def test_configured_type(self):
+        report_types.configure(
+            {'report_types': 'syndromic',
+             'report_type.syndromic.compression': 'gzip'},
+            ConfiguredReport)
+        context = Root(None)['syndromic']
+        self.assertTrue(isinstance(context, ConfiguredReport))
+        self.assertEqual(context.report_type, 'syndromic')
+        self.assertEqual(report_types.get('syndromic').compression, 'gzip')
+
+    def test_configured_bucket(self):
+        report_types.configure(
+            {'report_type.longitudinal.bucket': 'longitudinal',
+             'report_type.longitudinal.chunk_size': '1048576'},
+            ConfiguredReport)
+        self.assertEqual(report_types.bucket_name('longitudinal'),
+                         'longitudinal')
+        self.assertEqual(report_types.bucket_name('essence'), 'fs')
+        self.assertEqual(report_types.bucket_names(),
+                         ['fs', 'longitudinal'])
+        self.assertEqual(report_types.get('longitudinal').chunk_size,
+                         1048576)
+
+
 class TransferAgentTraversalTests(unittest.TestCase):
     def test_phinms_traversal(self):
         root = Root(None)
@@ -258,6 +352,7 @@ class TransferAgentTests(PersistTestFile):
         context = DistributeTransfer(testing.DummyRequest())
         context.request.fs = self.fs
         context.request.document_store = self.document_store
+        context.request.buckets = Buckets(self.db)
         context = context[str(self.oid)]
         self.assertFalse(inProduction())  # avoid accidental transfers!
         context.transfer_file()
@@ -271,6 +366,7 @@ class TransferAgentTests(PersistTestFile):
         context = PHINMS_Transfer(testing.DummyRequest())
         context.request.fs = self.fs
         context.request.document_store = self.document_store
+        context.request.buckets = Buckets(self.db)
         context = context[str(self.oid)]
         self.assertFalse(inProduction())  # avoid accidental transfers!
         context.transfer_file()
@@ -280,6 +376,32 @@ class TransferAgentTests(PersistTestFile):
         path = config.get('phinms', self.report_type)
         self.assertEqual(context.outbound_dir, path)
 
+    def testRecordTransfer(self):
+        self.create_test_file(compression='gzip',
+                              report_type='longitudinal')
+        context = PHINMS_Transfer(testing.DummyRequest())
+        context.request.buckets = Buckets(self.db)
+        context = context[str(self.oid)]
+        self.assertFalse(context.already_sent())
+        context.history_size = 2
+        for i in range(3):
+            context.record_transfer()
+
+        document = self.document_store.find_one(self.oid)
+        self.assertEqual(len(document['transfers']), 2)
+        self.assertEqual(document['transfers'][-1]['agent'], 'phin-ms')
+        self.assertEqual(document['last_transfer']['phin-ms'],
+                         document['transfer_date'])
+        # A fresh traversal sees the recorded transfer
+        context = PHINMS_Transfer(context.request)[str(self.oid)]
+        self.assertTrue(context.already_sent())
+
+        criteria = Search.not_transferred_by({'_id': self.oid}, 'phin-ms')
+        self.assertEqual(self.document_store.find(criteria).count(), 0)
+        criteria = Search.not_transferred_by({'_id': self.oid},
+                                             'distribute')
+        self.assertEqual(self.document_store.find(criteria).count(), 1)
+
     def testReportTypes(self):
         "A number of report types are mapped to directories"
         for e in ('essence_pcE', 'essence_pcI', 'essence_pcO',
@@ -294,6 +416,32 @@ class TransferAgentTests(PersistTestFile):
             self.assertTrue(agent.outbound_dir)
 
 
+class DeliveryWatcherTests(PersistTestFile):
+    """Unit test PHIN-MS delivery confirmation"""
+    def testPollDelivered(self):
+        self.create_test_file(report_type='longitudinal')
+        consumed = os.path.join(mkdtemp(), 'consumed')
+        self.document_store.update({'_id': self.oid}, {'$push': {
+            'transfers': {'agent': 'phin-ms', 'date': datetime.utcnow(),
+                          'path': consumed, 'delivered': False}}})
+        settings = {'db_conn': pymongo.Connection(),
+                    'db_name': 'report_archive'}
+        watcher = DeliveryWatcher(settings, [os.path.dirname(consumed)])
+        self.assertTrue((watcher.buckets.get().name, consumed) in
+                        [(b.name, p) for b, p in watcher.pending()])
+
+        # file never existed, as if PHIN-MS already consumed it
+        watcher.poll()
+        document = self.document_store.find_one(self.oid)
+        self.assertTrue(document['transfers'][0]['delivered'])
+        self.assertTrue(document['delivered_date'])
+        # recorded for the change feed, and other workers' caches
+        event = self.db['events'].find_one({'document_id': self.oid,
+                                            'event': 'delivered'})
+        self.assertTrue(event['seq'])
+        os.rmdir(os.path.dirname(consumed))
+
+
 class SearchTests(PersistTestFile):
     """Unit test search"""
     def setUp(self):
@@ -315,6 +463,21 @@ class SearchTests(PersistTestFile):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(r.text, json.dumps(self.test_text))
 
+    def testContentNotCached(self):
+        self.create_test_file(report_type='test')
+        request = testing.DummyRequest()
+        request.db = self.db
+        request.buckets = Buckets(self.db)
+        request.search_cache = SearchCache(max_entries=10)
+        search = Search(request)
+        found = search.search({'report_type': self.report_type,
+                               'filename':
+                               os.path.basename(self.tempfile.name)})
+        self.assertEqual(found, self.test_text)
+        self.assertEqual(len(request.search_cache), 0)
+        self.assertEqual(search.search({'filename': 'no such file'}), '')
+        self.assertEqual(len(request.search_cache), 1)
+
     def testTimeRangeSearch(self):
         # stuff a document in the db
         self.test_text = 'a document with start and end times'
@@ -338,6 +501,292 @@ class SearchTests(PersistTestFile):
         self.assertEqual(r.text, json.dumps(self.test_text))
 
 
+class MetadataTests(PersistTestFile):
+    """Functional test batch metadata and HEAD - requires service"""
+    def testBatchMetadata(self):
+        self.create_test_file(report_type='test')
+        missing = ObjectId()
+        url = 'http://localhost:6543/search/@@metadata?ids=%s,%s&'\
+            'fields=filename,length' % (missing, self.oid)
+        r = requests.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json()), 1)
+        self.assertEqual(r.json()[0]['filename'],
+                         os.path.basename(self.tempfile.name))
+        self.assertEqual(r.json()[0]['length'], len(self.test_text))
+        self.assertFalse('report_type' in r.json()[0])
+
+    def testHead(self):
+        self.create_test_file(report_type='test')
+        document = self.document_store.find_one(self.oid)
+        url = 'http://localhost:6543/test/%s' % self.oid
+        r = requests.head(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['X-Stored-Length'],
+                         str(len(self.test_text)))
+        self.assertEqual(r.headers['ETag'], '"%s"' % document['md5'])
+        self.assertTrue(r.headers['Last-Modified'])
+
+        # GET describes the document alike
+        get = requests.get(url)
+        for header in 'ETag', 'Last-Modified', 'X-Stored-Length':
+            self.assertEqual(get.headers[header], r.headers[header])
+
+
+class BulkDeleteTests(PersistTestFile):
+    """Functional test bulk delete - requires service"""
+    def testBulkDelete(self):
+        self.create_test_file(report_type='test')
+        search_criteria = {'report_type': self.report_type,
+                           'filename': os.path.basename(self.tempfile.name)}
+        url = 'http://localhost:6543/search?query=%s' %\
+            json.dumps(search_criteria)
+        r = requests.delete(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {'matched': 1, 'files': 1,
+                                    'chunks': 1})
+        self.assertFalse(self.fs.exists(self.oid))
+        del self.oid  # nothing left for tearDown
+
+    def testEmptyCriteria(self):
+        r = requests.delete('http://localhost:6543/search?query={}')
+        self.assertEqual(r.status_code, 400)
+
+
+class DerivedMetadataTests(unittest.TestCase):
+    """Unit test metadata derived while content is read"""
+    content = 'date,region,count\r\n2013-01-01,king,4\n2013-01-02,king,7'
+
+    def test_derived(self):
+        reader = DerivedMetadataReader(StringIO(self.content), header=True)
+        while reader.read(5):
+            pass
+        self.assertEqual(reader.metadata(), {
+            'uncompressed_length': len(self.content),
+            'sha256': hashlib.sha256(self.content).hexdigest(),
+            'header_row': 'date,region,count',
+            'record_count': 2})
+
+    def test_without_header(self):
+        reader = DerivedMetadataReader(StringIO('one\ntwo\n'))
+        self.assertEqual(list(reader), ['one\n', 'two\n'])
+        self.assertEqual(reader.metadata()['record_count'], 2)
+        self.assertFalse('header_row' in reader.metadata())
+
+    def test_seek_restarts(self):
+        reader = DerivedMetadataReader(StringIO(self.content))
+        reader.read()
+        reader.seek(0)
+        reader.read()
+        self.assertEqual(reader.metadata()['uncompressed_length'],
+                         len(self.content))
+
+
+class ExportTests(unittest.TestCase):
+    """Unit test the streaming archive writers"""
+    contents = {'essence/a.txt': 'a line of text\n' * 1000,
+                'essence/b.txt': os.urandom(100000),
+                'longitudinal/empty.txt': ''}
+
+    def members(self, sized=True):
+        for name, content in sorted(self.contents.items()):
+            blocks = [content[i:i + 4096]
+                      for i in range(0, len(content), 4096)]
+            yield Member(name, datetime.utcnow(),
+                         lambda blocks=blocks: iter(blocks),
+                         len(content) if sized else None)
+
+    def test_zip(self):
+        for deflate in (False, True):
+            archive = zipfile.ZipFile(StringIO(''.join(
+                zip_stream(self.members(), deflate))))
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(dict((name, archive.read(name)) for name
+                                  in archive.namelist()), self.contents)
+
+    def test_tar(self):
+        # unsized members are measured before their header is written
+        for sized in (True, False):
+            archive = tarfile.open(fileobj=StringIO(''.join(
+                tar_stream(self.members(sized)))))
+            self.assertEqual(dict((m.name, archive.extractfile(m).read())
+                                  for m in archive.getmembers()),
+                             self.contents)
+
+    def test_tar_mtime(self):
+        # uploadDate is naive UTC, independent of the local timezone
+        member = Member('epoch', datetime(1970, 1, 2), lambda: iter([]), 0)
+        archive = tarfile.open(fileobj=StringIO(''.join(
+            tar_stream([member]))))
+        self.assertEqual(archive.getmember('epoch').mtime, 86400)
+
+    def test_tar_size_mismatch(self):
+        member = Member('short', datetime.utcnow(), lambda: iter(['abc']),
+                        4)
+        self.assertRaises(IOError, list, tar_stream([member]))
+
+
+class ExportViewTests(PersistTestFile):
+    """Functional test export - requires service"""
+    def testExport(self):
+        self.create_test_file(report_type='test', compression='gzip')
+        search_criteria = {'report_type': self.report_type,
+                           'filename': os.path.basename(self.tempfile.name)}
+        url = 'http://localhost:6543/search/@@export?format=zip&'\
+            'expand=true&query=%s' % json.dumps(search_criteria)
+        r = requests.get(url)
+        self.assertEqual(r.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(r.content))
+        name = 'test/%s' % os.path.basename(self.tempfile.name)[:-3]
+        self.assertEqual(archive.read(name), self.test_text)
+
+
+class BulkUpdateTests(PersistTestFile):
+    """Functional test bulk metadata update - requires service"""
+    def testBulkUpdate(self):
+        self.create_test_file(report_type='test', end_time=datetime.now())
+        search_criteria = {'report_type': self.report_type,
+                           'filename': os.path.basename(self.tempfile.name)}
+        update = {'$set': {'end_time': '2013-07-01T00:00:00'}}
+        r = requests.post('http://localhost:6543/search/@@update',
+                          data={'query': json.dumps(search_criteria),
+                                'update': json.dumps(update)})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {'matched': 1, 'modified': 1})
+        document = self.document_store.find_one(self.oid)
+        self.assertEqual(document['end_time'], datetime(2013, 7, 1))
+
+    def testProtectedField(self):
+        self.create_test_file(report_type='test')
+        # versions are keyed on the identity fields, never updated
+        for field in 'report_type', 'reportable_region':
+            update = {'$set': {field: 'other'}}
+            r = requests.post('http://localhost:6543/search/@@update',
+                              data={'query': json.dumps(
+                                  {'_id': str(self.oid)}),
+                                  'update': json.dumps(update)})
+            self.assertEqual(r.status_code, 400)
+
+
+class ReadRoutingTests(unittest.TestCase):
+    """Unit test read preference configuration"""
+    def test_parse(self):
+        preferences = parse_preferences(
+            {'read_preference.search': 'secondaryPreferred',
+             'read_preference.listing': 'primary'})
+        self.assertEqual(preferences, {'search': pymongo.ReadPreference.
+                                       SECONDARY_PREFERRED})
+
+    def test_parse_invalid(self):
+        self.assertRaises(ValueError, parse_preferences,
+                          {'read_preference.search': 'anywhere'})
+
+    def test_standalone_uses_primary(self):
+        # A standalone mongod has no replica set status, so no lag
+        router = ReadRouter(pymongo.Connection(), 'report_archive',
+                            {'search': pymongo.ReadPreference.SECONDARY},
+                            max_staleness=90)
+        self.assertEqual(router.lag(), None)
+        self.assertEqual(router.buckets('search'), None)
+
+
+@unittest.skipUnless(os.environ.get('PHEME_TEST_REPLICA_SET'),
+                     "set PHEME_TEST_REPLICA_SET to a local replica set "
+                     "name to test secondary reads")
+class ReplicaSetRoutingTests(unittest.TestCase):
+    """Test read routing against a local replica set"""
+    def setUp(self):
+        self.conn = pymongo.MongoReplicaSetClient(
+            'mongodb://localhost/',
+            replicaSet=os.environ['PHEME_TEST_REPLICA_SET'])
+
+    def test_secondary_reads(self):
+        router = ReadRouter(self.conn, 'report_archive',
+                            {'search': pymongo.ReadPreference.
+                             SECONDARY_PREFERRED}, max_staleness=90)
+        self.assertTrue(router.lag() is not None)
+        buckets = router.buckets('search')
+        self.assertEqual(buckets.get().files.read_preference,
+                         pymongo.ReadPreference.SECONDARY_PREFERRED)
+        # Unconfigured view classes stay on the primary
+        self.assertEqual(router.buckets('metadata'), None)
+
+    def test_staleness_bound(self):
+        router = ReadRouter(self.conn, 'report_archive',
+                            {'search': pymongo.ReadPreference.SECONDARY},
+                            max_staleness=-1)
+        self.assertEqual(router.buckets('search'), None)
+
+    def test_secondary_searches_not_cached(self):
+        request = testing.DummyRequest()
+        request.db = self.conn['report_archive']
+        request.buckets = Buckets(request.db)
+        request.search_cache = SearchCache(max_entries=10)
+        request.read_router = ReadRouter(
+            self.conn, 'report_archive',
+            {'search': pymongo.ReadPreference.SECONDARY_PREFERRED},
+            max_staleness=90)
+        self.assertEqual(Search(request).search({'filename': 'no such'}),
+                         '')
+        self.assertEqual(len(request.search_cache), 0)
+
+
+class ChangeFeedTests(PersistTestFile):
+    """Functional test the change feed - requires service"""
+    def testResume(self):
+        r = requests.get('http://localhost:6543/changes?timeout=1')
+        self.assertEqual(r.status_code, 200)
+        events = r.json()
+        since = events[-1]['seq'] if events else None
+
+        self.create_test_file(report_type='test')
+        record_event(self.db, 'upload', [self.document_store.
+                                         find_one(self.oid)])
+        url = 'http://localhost:6543/changes?timeout=5&report_type=test'
+        if since:
+            url += '&since=%s' % since
+        events = requests.get(url).json()
+        self.assertEqual(events[-1]['document_id'], str(self.oid))
+        self.assertEqual(events[-1]['event'], 'upload')
+        if since:
+            self.assertTrue(events[0]['seq'] > since)
+
+    def testSequence(self):
+        self.create_test_file(report_type='test')
+        document = self.document_store.find_one(self.oid)
+        record_event(self.db, 'upload', [document, document])
+        first, second = self.db['events'].find(
+            {'document_id': self.oid}).sort('$natural', -1).limit(2)
+        self.assertEqual(first['seq'], second['seq'] + 1)
+
+    def testCriteria(self):
+        self.assertEqual(event_criteria('42', report_type='essence',
+                                        reportable_region=None),
+                         {'seq': {'$gt': 42}, 'report_type': 'essence'})
+        self.assertRaises(ValueError, event_criteria, str(ObjectId()))
+
+
+class ConsumerLimitTests(unittest.TestCase):
+    """Unit test the change feed consumer limit"""
+    def test_limit(self):
+        consumers = ConsumerLimit(max_consumers=2)
+        self.assertTrue(consumers.acquire())
+        self.assertTrue(consumers.acquire())
+        self.assertFalse(consumers.acquire())
+        consumers.release()
+        self.assertTrue(consumers.acquire())
+
+    def test_released_on_close(self):
+        consumers = ConsumerLimit(max_consumers=1)
+        consumers.acquire()
+        body = ReleasingIterable(iter(['a', 'b']), consumers.release)
+        self.assertEqual(list(body), ['a', 'b'])
+        self.assertFalse(consumers.acquire())
+        body.close()
+        body.close()  # released once only
+        self.assertEqual(consumers.consumers, 0)
+
+
 class ZipTests(TestFile):
     """Test the zip & expand compression functions"""
     def setUp(self):
@@ -382,6 +831,398 @@ class ZipTests(TestFile):
         self.assertEqual(expanded.read(), self.test_text)
 
 
+class AdmissionTests(unittest.TestCase):
+    """Unit test admission control lanes and byte budget"""
+    def setUp(self):
+        self.controller = AdmissionController(
+            small_slots=2, large_slots=1, max_bytes=1000, large_bytes=100,
+            queue_timeout=0.01, retry_after=7)
+
+    def test_lanes(self):
+        large = self.controller.admit(500)
+        self.assertEqual(large.lane, 'large')
+        # the large lane is full, small requests still get through
+        self.assertRaises(Overloaded, self.controller.admit, 200)
+        small = self.controller.admit(10)
+        self.assertEqual(small.lane, 'small')
+        large.release()
+        self.controller.admit(200).release()
+        small.release()
+        self.assertEqual(self.controller.bytes_in_flight, 0)
+
+    def test_byte_budget(self):
+        tickets = [self.controller.admit(50), self.controller.admit(50)]
+        self.assertRaises(Overloaded, self.controller.admit, 0)
+        tickets[0].charge(850)
+        self.assertEqual(tickets[0].lane, 'large')
+        try:
+            tickets[1].charge(100)
+        except Overloaded as e:
+            self.assertEqual(e.status_int, 503)
+            self.assertEqual(e.headers['Retry-After'], '7')
+        else:
+            self.fail("charge beyond max_bytes admitted")
+        for ticket in tickets:
+            ticket.release()
+        self.assertEqual(self.controller.in_flight,
+                         {'small': 0, 'large': 0})
+
+    def test_oversized_alone(self):
+        # larger than the whole budget, admitted when nothing else is
+        ticket = self.controller.admit(5000)
+        self.assertRaises(Overloaded, self.controller.admit, 10)
+        ticket.release()
+
+
+class StreamingRendererTests(unittest.TestCase):
+    """Unit test incremental JSON encoding of search results"""
+    def test_encode_stream(self):
+        now = datetime(2013, 1, 1, 12, 30)
+        documents = [{'_id': ObjectId(), 'uploadDate': now, 'length': i}
+                     for i in range(100)]
+        blocks = list(encode_stream(iter(documents), block_size=1024))
+        self.assertTrue(len(blocks) > 1)
+        decoded = json.loads(''.join(blocks))
+        self.assertEqual(len(decoded), 100)
+        self.assertEqual(decoded[9], {'_id': str(documents[9]['_id']),
+                                      'uploadDate': now.isoformat(),
+                                      'length': 9})
+
+    def test_empty(self):
+        self.assertEqual(''.join(encode_stream(iter([]))), '[]')
+
+    def test_unknown_type(self):
+        self.assertRaises(TypeError, list, encode_stream(iter([{
+            'unknown': object()}])))
+
+
+class MemoryMonitorTests(unittest.TestCase):
+    """Unit test per request memory high-water"""
+    def tearDown(self):
+        # the monitor starts tracing, which slows everything else
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    def test_worst(self):
+        monitor = MemoryMonitor(threshold=1024 * 1024, keep=10)
+        small = monitor.begin('GET', '/search')
+        monitor.end(small)
+        large = monitor.begin('GET', '/essence/large')
+        large.document_id = ObjectId()
+        held = ' ' * (8 * 1024 * 1024)
+        monitor.sample()
+        del held
+        monitor.end(large)
+        worst = monitor.worst(limit=1)
+        self.assertEqual(len(worst), 1)
+        self.assertEqual(worst[0]['path'], '/essence/large')
+        self.assertEqual(worst[0]['document_id'], large.document_id)
+        self.assertTrue(worst[0]['peak'] >= 8 * 1024 * 1024)
+
+    def test_keep(self):
+        monitor = MemoryMonitor(keep=3)
+        for i in range(5):
+            monitor.end(monitor.begin('GET', '/%d' % i))
+        self.assertEqual(len(monitor.worst()), 3)
+
+
+class ForkSafeClientTests(unittest.TestCase):
+    """Unit test a client per process"""
+    def setUp(self):
+        self.getpid = connection.os.getpid
+
+    def tearDown(self):
+        connection.os.getpid = self.getpid
+
+    def test_client_per_process(self):
+        clients = ForkSafeClient(object)
+        parent = clients.client
+        self.assertTrue(clients.client is parent)
+        connection.os.getpid = lambda: -1  # as if forked
+        self.assertFalse(clients.client is parent)
+
+
+class WorkerMetricsTests(unittest.TestCase):
+    """Unit test the per worker request counts"""
+    def test_counts(self):
+        metrics = WorkerMetrics()
+        metrics.begin()
+        metrics.end(200, 0.5)
+        metrics.begin()
+        metrics.end(503, 0.25)
+        counts = metrics.snapshot()
+        self.assertEqual((counts['requests'], counts['2xx'],
+                          counts['5xx'], counts['in_flight']),
+                         (2, 1, 1, 0))
+        self.assertEqual(counts['seconds'], 0.75)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['requests'], 0)
+
+
+class ContentCacheTests(unittest.TestCase):
+    """Unit test the byte budgeted content cache"""
+    def test_hit(self):
+        cache = ContentCache(max_bytes=100, max_item_bytes=10)
+        self.assertTrue(cache.put('a', 'md5a', 'abc'))
+        self.assertEqual(cache.get('a', 'md5a'), 'abc')
+        self.assertEqual(cache.total_bytes, 3)
+
+    def test_md5_mismatch(self):
+        cache = ContentCache(max_bytes=100, max_item_bytes=10)
+        cache.put('a', 'md5a', 'abc')
+        self.assertEqual(cache.get('a', 'changed'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_item_too_large(self):
+        cache = ContentCache(max_bytes=100, max_item_bytes=2)
+        self.assertFalse(cache.put('a', 'md5a', 'abc'))
+        self.assertEqual(cache.get('a', 'md5a'), None)
+
+    def test_lru_eviction(self):
+        cache = ContentCache(max_bytes=6, max_item_bytes=6)
+        cache.put('a', 'md5a', 'aaa')
+        cache.put('b', 'md5b', 'bbb')
+        cache.get('a', 'md5a')  # 'b' is now least recently used
+        cache.put('c', 'md5c', 'ccc')
+        self.assertEqual(cache.get('b', 'md5b'), None)
+        self.assertEqual(cache.get('a', 'md5a'), 'aaa')
+        self.assertEqual(cache.total_bytes, 6)
+
+    def test_invalidate(self):
+        cache = ContentCache(max_bytes=100, max_item_bytes=10)
+        cache.put('a', 'md5a', 'abc')
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a', 'md5a'), None)
+        self.assertEqual(cache.total_bytes, 0)
+
+
+class SearchCacheTests(unittest.TestCase):
+    """Unit test search result caching"""
+    def test_sync(self):
+        cache = SearchCache(4, shared=True)
+        cache.sync('first event')
+        generation = cache.generation
+        cache.sync('first event')
+        self.assertEqual(cache.generation, generation)
+        cache.sync('written by another worker')
+        self.assertEqual(cache.generation, generation + 1)
+
+    def test_canonical_key_order(self):
+        a = {'report_type': 'essence', 'filename': 'x'}
+        b = {'filename': 'x', 'report_type': 'essence'}
+        self.assertEqual(canonical_criteria(a), canonical_criteria(b))
+
+    def test_canonical_types(self):
+        when = datetime(2013, 7, 1)
+        self.assertNotEqual(canonical_criteria({'a': when}),
+                            canonical_criteria({'a': when.isoformat()}))
+
+    def test_hit_until_bump(self):
+        cache = SearchCache(max_entries=10)
+        key = cache.key({'report_type': 'essence'}, 0)
+        cache.put(key, ['doc'], cache.generation)
+        self.assertEqual(cache.get(key), (True, ['doc']))
+        cache.bump()
+        self.assertEqual(cache.get(key), (False, None))
+
+    def test_stale_generation_not_cached(self):
+        cache = SearchCache(max_entries=10)
+        key = cache.key({'report_type': 'essence'}, 0)
+        generation = cache.generation
+        cache.bump()  # a write raced the search
+        cache.put(key, ['doc'], generation)
+        self.assertEqual(cache.get(key), (False, None))
+
+    def test_large_results_streamed(self):
+        request = testing.DummyRequest()
+        request.buckets = None
+        request.search_cache = SearchCache(max_entries=10, max_documents=3)
+        search = Search(request)
+        for count, cached in ((3, True), (4, False)):
+            search._search = lambda criteria, limit, buckets:\
+                itertools.chain(iter(range(count)))
+            found = search.search({'count': count})
+            self.assertEqual(list(found), list(range(count)))
+            self.assertEqual(isinstance(found, list), cached)
+        self.assertEqual(len(request.search_cache), 1)
+
+    def test_max_entries(self):
+        cache = SearchCache(max_entries=2)
+        for i in range(3):
+            cache.put(cache.key({'i': i}, 0), i, cache.generation)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(cache.key({'i': 0}, 0)), (False, None))
+
+
+class DeltaTests(unittest.TestCase):
+    """Unit test delta encoding and reconstruction"""
+    def setUp(self):
+        self.base = "".join("record %d,value\n" % i for i in range(1000))
+
+    def round_trip(self, target, max_index_lines=delta.MAX_INDEX_LINES):
+        out = StringIO()
+        target_length, delta_length = delta.encode(
+            StringIO(self.base), StringIO(target), out, max_index_lines)
+        self.assertEqual(target_length, len(target))
+        self.assertEqual(delta_length, len(out.getvalue()))
+        out.seek(0)
+        reader = delta.DeltaReader(StringIO(self.base), out)
+        self.assertEqual(reader.read(), target)
+        return delta_length
+
+    def test_identical(self):
+        self.assertTrue(self.round_trip(self.base) < 32)
+
+    def test_appended(self):
+        appended = "record 1000,value\n"
+        size = self.round_trip(self.base + appended)
+        self.assertTrue(size < 64 + len(appended))
+
+    def test_edited(self):
+        lines = self.base.splitlines(True)
+        lines[10] = "edited\n"
+        del lines[500:510]
+        self.round_trip("".join(lines))
+
+    def test_index_bounded(self):
+        first_offset, digest_at = delta.index_lines(StringIO(self.base), 100)
+        self.assertEqual(len(digest_at), 100)
+        # lines past the index are stored as inserts, still round trip
+        size = self.round_trip(self.base, max_index_lines=100)
+        self.assertTrue(size > len(self.base) * 0.8)
+
+    def test_unrelated(self):
+        self.round_trip("nothing in common, no newline")
+
+    def test_incremental_read(self):
+        target = self.base.replace("record 42,", "record 42!")
+        out = StringIO()
+        delta.encode(StringIO(self.base), StringIO(target), out)
+        out.seek(0)
+        reader = delta.DeltaReader(StringIO(self.base), out)
+        self.assertEqual("".join(iter(lambda: reader.read(7), "")),
+                         target)
+
+    def test_not_a_delta(self):
+        self.assertRaises(ValueError, delta.DeltaReader,
+                          StringIO(self.base), StringIO("garbage"))
+
+
+class PackStoreTests(unittest.TestCase):
+    """Unit test the archive tier pack files"""
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.store = PackStore(self.directory, max_pack_bytes=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        content = "".join("record %d\n" % i for i in range(10000))
+        pointer = self.store.append(ObjectId(), StringIO(content))
+        self.assertEqual(pointer['length'], len(content))
+        self.assertTrue(pointer['stored_length'] < len(content))
+        self.assertEqual(self.store.open(pointer).read(), content)
+
+    def test_seek(self):
+        content = "".join("record %d\n" % i for i in range(10000))
+        reader = self.store.open(self.store.append(ObjectId(),
+                                                   StringIO(content)))
+        reader.seek(50000)
+        self.assertEqual(reader.read(10), content[50000:50010])
+        reader.seek(3)
+        self.assertEqual(reader.read(10), content[3:13])
+
+    def test_multiple_packs(self):
+        pointers = [self.store.append(ObjectId(), StringIO(os.urandom(2000)))
+                    for i in range(3)]
+        self.assertEqual(len(set(p['pack'] for p in pointers)), 3)
+        contents = [StringIO("first"), StringIO("second")]
+        first, second = [self.store.append(ObjectId(), c) for c in contents]
+        self.assertEqual(self.store.open(first).read(), "first")
+        self.assertEqual(self.store.open(second).read(), "second")
+
+    def test_directory_created_on_append(self):
+        directory = os.path.join(self.directory, 'packs')
+        store = PackStore(directory)
+        self.assertFalse(os.path.exists(directory))
+        store.append(ObjectId(), StringIO("content"))
+        self.assertTrue(os.path.isdir(directory))
+
+    def test_readline(self):
+        content = "".join("record %d\n" % i for i in range(10000)) + "tail"
+        reader = self.store.open(self.store.append(ObjectId(),
+                                                   StringIO(content)))
+        self.assertEqual(reader.readline(3), "rec")
+        self.assertEqual(reader.readline(), "ord 0\n")
+        lines = list(iter(reader.readline, ""))
+        self.assertEqual(lines[-1], "tail")
+        self.assertEqual("".join(lines), content[len("record 0\n"):])
+
+
+class ArchivedDeltaTests(unittest.TestCase):
+    """Delta encode against a snapshot moved to the archive tier"""
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.store = packs.configure(self.directory)
+        self.db = pymongo.Connection()['report_archive']
+        self.bucket = Bucket(self.db, 'test_delta')
+        self.base = "".join("record %d,value\n" % i for i in range(1000))
+
+    def tearDown(self):
+        self.db.drop_collection('test_delta.files')
+        self.db.drop_collection('test_delta.chunks')
+        packs._pack_store = None
+        shutil.rmtree(self.directory)
+
+    def test_put_against_archived_base(self):
+        oid = self.bucket.fs.put(StringIO(self.base), filename='delta')
+        archive_document(self.bucket, self.bucket.files.find_one(oid),
+                         self.store)
+        previous = self.bucket.files.find_one(oid)
+        self.assertTrue(previous['archive'])
+
+        target = self.base.replace("record 42,", "record 42!")
+        new_id = delta.put(self.bucket.fs, StringIO(target), previous,
+                           snapshot_interval=10, max_ratio=0.5,
+                           filename='delta')
+        document = self.bucket.files.find_one(new_id)
+        self.assertEqual(document['storage'], 'delta')
+        self.assertEqual(document['delta_base'], oid)
+        reader = delta.open_delta(self.bucket.fs, document)
+        self.assertEqual(reader.read(), target)
+
+
+class PurgeDeltaTests(unittest.TestCase):
+    """Purging a snapshot preserves the versions encoded against it"""
+    def setUp(self):
+        self.db = pymongo.Connection()['report_archive']
+        self.bucket = Bucket(self.db, 'test_purge')
+        self.base = "".join("record %d,value\n" % i for i in range(1000))
+
+    def tearDown(self):
+        self.db.drop_collection('test_purge.files')
+        self.db.drop_collection('test_purge.chunks')
+
+    def test_purge_base(self):
+        base_id = self.bucket.fs.put(StringIO(self.base), filename='purge',
+                                     version=1)
+        target = self.base.replace("record 42,", "record 42!")
+        dependent_id = delta.put(
+            self.bucket.fs, StringIO(target),
+            self.bucket.files.find_one(base_id), snapshot_interval=10,
+            max_ratio=0.5, filename='purge', version=2)
+        self.assertEqual(self.bucket.files.find_one(dependent_id)
+                         ['storage'], 'delta')
+
+        self.assertEqual(purge_documents(self.bucket, [base_id])[0], 1)
+        self.assertEqual(self.bucket.files.find_one(base_id), None)
+        document = self.bucket.files.find_one(dependent_id)
+        self.assertFalse(document.get('storage'))
+        self.assertEqual(open_stored(self.bucket.fs, document).read(),
+                         target)
+
+
 class TestReportSubmission(TestFile):
     """Functional tests using http - requires service"""
 
@@ -426,6 +1267,11 @@ class TestReportSubmission(TestFile):
         # Given the traversal included _pcE, test patient class
         self.assertEqual(report.patient_class, 'E')
 
+        # Metadata derived from the uncompressed upload
+        self.assertEqual(report.uncompressed_length, len(self.test_text))
+        self.assertEqual(report.sha256,
+                         hashlib.sha256(self.test_text).hexdigest())
+
         # confirm view for the uploaded document works
         url = 'http://localhost:6543/essence_pcE/%s' % oid
         r = requests.get(url)
@@ -440,6 +1286,91 @@ class TestReportSubmission(TestFile):
         self.assertRaises(NoFile, fs.get, oid)
 
 
+class TestVersioning(TestFile):
+    """Functional tests of document versions - requires service"""
+
+    def testVersions(self):
+        filename = self.create_test_file(compression=None)
+        basename = os.path.basename(filename)
+        url = 'http://localhost:6543/essence/%s' % basename
+        payload = {'allow_duplicate_filename': True}
+        oids = []
+        for text in ('first version', 'second version'):
+            with open(filename, 'wb') as fh:
+                fh.write(text)
+            files = {basename: open(filename, 'rb')}
+            r = requests.put(url, files=files, data=payload)
+            self.assertEqual(r.status_code, 200)
+            oids.append(r.json()['document_id'])
+
+        # GET by filename resolves to the latest
+        r = requests.get(url)
+        self.assertTrue('second version' in r.text)
+
+        r = requests.get(url + '/@@versions')
+        versions = r.json()
+        self.assertEqual([v['id'] for v in versions], oids[::-1])
+        self.assertEqual([v['latest'] for v in versions], [True, False])
+        self.assertEqual(versions[0]['version'],
+                         versions[1]['version'] + 1)
+
+        # Deleting the latest promotes the previous version
+        requests.delete('http://localhost:6543/essence/%s' % oids[1])
+        r = requests.get(url)
+        self.assertTrue('first version' in r.text)
+        requests.delete('http://localhost:6543/essence/%s' % oids[0])
+
+
+class VersionIdentityTests(unittest.TestCase):
+    """Versions are kept per report identity, not just filename"""
+    def setUp(self):
+        self.db = pymongo.Connection()['report_archive']
+        self.fs = GridFS(self.db)
+        self.oids = []
+
+    def tearDown(self):
+        for oid in self.oids:
+            self.fs.delete(oid)
+
+    def test_identity(self):
+        identity = report_identity('essence', 'f.csv',
+                                   {'reportable_region': 'wa',
+                                    'other': 1})
+        self.assertEqual(identity, {'report_type': 'essence',
+                                    'filename': 'f.csv',
+                                    'reportable_region': 'wa',
+                                    'patient_class': None,
+                                    'include_updates': None})
+        self.assertEqual(report_identity('essence', 'f.csv',
+                                         {'patient_class': 'E'},
+                                         partial=True),
+                         {'report_type': 'essence', 'filename': 'f.csv',
+                          'patient_class': 'E'})
+
+    def test_version_key(self):
+        self.assertEqual(version_key(report_identity('essence', 'f.csv')),
+                         'essence/f.csv')
+        self.assertNotEqual(
+            version_key(report_identity('essence', 'f.csv',
+                                        {'reportable_region': 'wa'})),
+            version_key(report_identity('essence', 'f.csv',
+                                        {'reportable_region': 'or'})))
+
+    def test_latest_per_identity(self):
+        filename = 'identity-%s' % ObjectId()
+        identities = [report_identity('test', filename,
+                                      {'reportable_region': region})
+                      for region in ('wa', 'or')]
+        for identity in identities:
+            oid = self.fs.put("content", version=1, latest=True,
+                              **identity)
+            self.oids.append(oid)
+            mark_latest(self.db['fs.files'], oid, identity, 1)
+        for identity, oid in zip(identities, self.oids):
+            self.assertEqual(find_latest(self.db['fs.files'],
+                                         identity)['_id'], oid)
+
+
 class TestReportTransfer(PersistTestFile):
     """Functional tests using http - requires service"""
 
@@ -1,16 +1,37 @@
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from gridfs.errors import NoFile
 import json
 from pyramid.exceptions import NotFound
 from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
 from pyramid.view import view_config
 import logging
 import os
 
-from pheme.util.compression import expand_file, zip_file
+from pheme.util.compression import zip_file
 from pheme.util.format import decode_isofomat_datetime
+from pheme.webAPI import delta, report_types
+from pheme.webAPI.derived import DerivedMetadataReader
+from pheme.webAPI.memory import tag_document
+from pheme.webAPI.admission import Overloaded
+from pheme.webAPI.events import event_criteria, record_event
+from pheme.webAPI.events import ReleasingIterable
+from pheme.webAPI.events import server_sent_events, tail_events
+from pheme.webAPI.export import content_length, tar_stream, zip_stream
 from pheme.webAPI.resources import BaseReport
+from pheme.webAPI.resources import ChangeFeed
+from pheme.webAPI.resources import document_content
+from pheme.webAPI.resources import find_latest
+from pheme.webAPI.resources import IDENTITY_FIELDS
+from pheme.webAPI.resources import invalidate_searches
+from pheme.webAPI.resources import mark_latest
+from pheme.webAPI.resources import MemoryReport
+from pheme.webAPI.resources import Metrics
+from pheme.webAPI.resources import next_version
+from pheme.webAPI.resources import report_identity
+from pheme.webAPI.resources import read_buckets
+from pheme.webAPI.resources import Retention
 from pheme.webAPI.resources import Search
 from pheme.webAPI.resources import TransferAgent
 
@@ -23,10 +44,93 @@ def display_meta_data(context, request):
         oid = ObjectId(context.filename)
     except InvalidId:
         raise NotFound
-    return request.document_store.find_one(oid)
+    bucket, document = context.locate(oid, read_buckets(request,
+                                                        'metadata'))
+    return document
+
+
+@view_config(context=Search, request_method='GET', name='metadata',
+             renderer='json')
+@view_config(context=Search, request_method='POST', name='metadata',
+             renderer='json')
+def batch_meta_data(context, request):
+    """Present metadata for many documents in a single request
+
+    :query param ids: comma separated document ids, POST a form for
+      more ids than fit in a URL
+    :query param fields: optional comma separated metadata fields to
+      return, otherwise the complete metadata is returned
+    :query param report_type: optionally limit the lookup to the
+      report_type's bucket
+
+    Returns a list of metadata, in the order requested.  Unknown ids
+    are left out.
+
+    """
+    try:
+        oids = [ObjectId(oid) for oid in
+                aslist(request.params.get('ids', '').replace(',', ' '))]
+    except InvalidId as e:
+        raise HTTPBadRequest(str(e))
+    if not oids:
+        raise HTTPBadRequest("Missing ids")
+    fields = aslist(request.params.get('fields', '').replace(',', ' '))
+    return context.metadata(oids, fields or None,
+                            request.params.get('report_type'))
+
+
+def identity_params(request):
+    """Return the report identity fields given as query params
+
+    include_updates is taken as a boolean, as sent in upload metadata.
+
+    """
+    identity = dict((k, request.params[k]) for k in IDENTITY_FIELDS
+                    if k in request.params)
+    if 'include_updates' in identity:
+        identity['include_updates'] = asbool(identity['include_updates'])
+    return identity
 
 
 @view_config(context=BaseReport, request_method='GET',
+             name='versions', renderer='json')
+def display_versions(context, request):
+    """List all versions of the requested report, newest first
+
+    :query param reportable_region, patient_class, include_updates:
+      optionally narrow the listing to one report's versions
+
+    """
+    if not hasattr(context, 'filename') or\
+            not hasattr(context, 'report_type'):
+        raise NotFound
+    versions = context.versions(identity_params(request))
+    if not versions:
+        raise NotFound
+    return versions
+
+
+def document_headers(document, response):
+    """Set the headers describing document on response, returning it
+
+    Set alike for GET and HEAD, from the metadata alone: ETag is the
+    GridFS md5 and Last-Modified the uploadDate.  The length of the
+    document as stored is sent as X-Stored-Length and, when derived
+    on upload, its uncompressed length as X-Uncompressed-Length.
+    Content-Length is that of the rendered page, so a HEAD request,
+    which reads no chunks, doesn't send it.
+
+    """
+    response.etag = document.get('md5')
+    response.last_modified = document['uploadDate']
+    response.headers['X-Stored-Length'] = str(content_length(document))
+    if document.get('uncompressed_length') is not None:
+        response.headers['X-Uncompressed-Length'] = str(
+            document['uncompressed_length'])
+    return response
+
+
+@view_config(context=BaseReport, request_method=('GET', 'HEAD'),
              renderer='pheme.webAPI:templates/display.pt')
 def display_reports(context, request):
     """View callable method for displaying one or more reports
@@ -40,55 +144,56 @@ def display_reports(context, request):
     the context is a subclass of BaseReport, the list will be limited
     to those reports of like type.
 
+    A HEAD request for a file is answered from the metadata alone,
+    see `document_headers`.
+
     """
     # If traversal included a filename, display file contents
     if hasattr(context, 'filename'):
+        # Attempt to access 'filename' as the document ID
         try:
-            # Attempt to access 'filename' as the document ID
-            try:
-                oid = ObjectId(context.filename)
-            except InvalidId:
-                raise NoFile
-            content = request.fs.get(oid)
-            document = request.document_store.find_one(oid)
-            compression = document.get('compression')
-
-        except NoFile:
-            # If the oid was not found, query filename of this type,
-            # if the context provided adequate data
+            bucket, document = context.locate(ObjectId(context.filename))
+        except InvalidId:
+            document = None
+
+        if not document:
+            # If the oid was not found, query the latest version of
+            # filename of this type, if the context provided adequate data
             try:
-                document = request.document_store.\
-                    find_one({'filename': context.filename,
-                              'report_type': context.report_type})
+                document = find_latest(context.bucket.files,
+                                       context.identity(
+                                           identity_params(request)))
             except AttributeError:
                 document = None
             if not document:
                 raise NotFound
-            content = request.fs.get(document['_id'])
-            compression = document.get('compression')
 
-        if compression:
-            content = expand_file(fileobj=content,
-                                  zip_protocol=compression)
-        return {'document': content.read()}
+        if request.method == 'HEAD':
+            return document_headers(document, Response(app_iter=[]))
+        document_headers(document, request.response)
+        return {'document': document_content(request, document)}
 
     # Otherwise, query for all reports of this type
     documents = ({'filename': doc['filename'],
                   'uploadDate': doc['uploadDate'],
                   'length': doc['length'],
                   'id': doc['_id']}
-                 for doc in request.document_store.
+                 for doc in read_buckets(request, 'listing').
+                 for_type(context.report_type).files.
                  find({'report_type': context.report_type})
                  if 'filename' in doc)
     return {'documents': documents, 'report_type': context.report_type}
 
 
-@view_config(context=Search, request_method='GET', renderer='json')
+@view_config(context=Search, request_method='GET', renderer='json_stream')
 def find_documents(context, request):
     """Present contents or metadata for multiple matching document(s)
 
     :query param query: JSONified dictionary defining search criteria
     :query param limit: optional restriction to size of result set
+    :query param not_transferred_by: optional transfer agent name
+      (i.e. 'phin-ms'), limiting results to documents that agent has
+      yet to transfer
 
     If only a single document is found to match search criteria, the
     document contents will be returned.
@@ -102,9 +207,252 @@ def find_documents(context, request):
     query = request.params.get('query')
     criteria = decode_isofomat_datetime(json.loads(query))
     limit = int(request.params.get('limit', 0))  # limit of 0 == no limit
+    agent = request.params.get('not_transferred_by')
+    if agent:
+        criteria = context.not_transferred_by(criteria, agent)
     return context.search(criteria, limit)
 
 
+# Named @@delete view for clients which can't send method=DELETE
+@view_config(context=Search, request_method='DELETE', renderer='json')
+@view_config(context=Search, request_method='POST', name='delete',
+             renderer='json')
+def bulk_delete(context, request):
+    """Delete all documents matching search criteria
+
+    :query param query: JSONified dictionary defining search criteria,
+      as used by `find_documents`
+    :query param confirm: must be set true when the number of matching
+      documents exceeds the configured `bulk_delete.confirm_threshold`
+    :query param stream: set true to receive a line of JSON progress
+      after each batch, rather than a single response on completion
+
+    Returns the count of files and chunks removed.
+
+    """
+    query = request.params.get('query')
+    if not query:
+        raise HTTPBadRequest("Missing query")
+    criteria = decode_isofomat_datetime(json.loads(query))
+    if not criteria:
+        raise HTTPBadRequest("Refusing to delete with empty criteria")
+
+    settings = request.registry.settings
+    threshold = int(settings.get('bulk_delete.confirm_threshold', 100))
+    batch_size = int(settings.get('bulk_delete.batch_size', 500))
+    matched = context.count(criteria)
+    if matched > threshold and not asbool(request.params.get('confirm')):
+        err = "%d documents match, confirm required to delete more "\
+            "than %d" % (matched, threshold)
+        logging.error(err)
+        raise HTTPBadRequest(err)
+
+    logging.info("bulk delete of %d documents matching %s", matched,
+                 query)
+    progress = context.bulk_delete(criteria, batch_size)
+    if asbool(request.params.get('stream')):
+        def app_iter():
+            files = chunks = 0
+            for files, chunks in progress:
+                yield json.dumps({'matched': matched, 'files': files,
+                                  'chunks': chunks}) + '\n'
+            yield json.dumps({'matched': matched, 'files': files,
+                              'chunks': chunks, 'done': True}) + '\n'
+        return Response(app_iter=app_iter(),
+                        content_type='application/json')
+
+    files = chunks = 0
+    for files, chunks in progress:
+        pass
+    return {'matched': matched, 'files': files, 'chunks': chunks}
+
+
+# Named @@update view for clients which can't send method=PATCH
+@view_config(context=Search, request_method='PATCH', renderer='json')
+@view_config(context=Search, request_method='POST', name='update',
+             renderer='json')
+def bulk_update(context, request):
+    """Update metadata of all documents matching search criteria
+
+    :query param query: JSONified dictionary defining search criteria,
+      as used by `find_documents`
+    :query param update: JSONified update, limited to `$set` and
+      `$unset` of the fields named in `bulk_update.fields`, i.e.
+      {"$set": {"end_time": "2013-07-01T00:00:00"}}.  The fields
+      identifying a report's versions (IDENTITY_FIELDS) are never
+      updated, doing so would leave versions and latest flags
+      inconsistent.
+
+    Returns the count of documents matched and modified.
+
+    """
+    query = request.params.get('query')
+    update = request.params.get('update')
+    if not query or not update:
+        raise HTTPBadRequest("Missing query or update")
+    criteria = decode_isofomat_datetime(json.loads(query))
+    if not criteria:
+        raise HTTPBadRequest("Refusing to update with empty criteria")
+    update = decode_isofomat_datetime(json.loads(update))
+
+    allowed = set(aslist(request.registry.settings.get(
+        'bulk_update.fields', 'start_time end_time'))) -\
+        set(IDENTITY_FIELDS)
+    if not update or not isinstance(update, dict):
+        raise HTTPBadRequest("Empty update")
+    for operator, fields in update.items():
+        if operator not in ('$set', '$unset') or\
+                not isinstance(fields, dict) or not fields:
+            raise HTTPBadRequest("Unsupported update '%s'" % operator)
+        for field in fields:
+            if field.split('.')[0] not in allowed:
+                err = "Update of '%s' not permitted" % field
+                logging.error(err)
+                raise HTTPBadRequest(err)
+
+    matched, modified = context.bulk_update(criteria, update)
+    logging.info("bulk update %s of %d documents matching %s", update,
+                 matched, query)
+    return {'matched': matched, 'modified': modified}
+
+
+@view_config(context=Search, request_method='GET', name='export')
+def export_documents(context, request):
+    """Stream an archive of all documents matching search criteria
+
+    :query param query: JSONified dictionary defining search criteria,
+      as used by `find_documents`
+    :query param format: 'zip' (default) or 'tar'
+    :query param expand: set true to decompress compressed documents
+      within the archive, otherwise they are included as stored
+
+    The archive is generated while it downloads, so exports aren't
+    limited by server memory or disk.
+
+    """
+    query = request.params.get('query')
+    if not query:
+        raise HTTPBadRequest("Missing query")
+    criteria = decode_isofomat_datetime(json.loads(query))
+    format = request.params.get('format', 'zip')
+    if format not in ('tar', 'zip'):
+        raise HTTPBadRequest("Unsupported export format '%s'" % format)
+    expand = asbool(request.params.get('expand'))
+
+    members = context.export(criteria, expand)
+    if format == 'tar':
+        app_iter = tar_stream(members)
+        content_type = 'application/x-tar'
+    else:
+        # deflate expanded content, compressed documents are stored
+        app_iter = zip_stream(members, deflate=expand)
+        content_type = 'application/zip'
+    return Response(app_iter=app_iter, content_type=content_type,
+                    content_disposition='attachment; filename=export.%s'
+                    % format)
+
+
+@view_config(context=ChangeFeed, request_method='GET', renderer='json')
+def follow_changes(context, request):
+    """Long poll, or stream, document change events
+
+    Events are one of 'upload', 'update', 'delete', 'transfer' or
+    'delivered' (PHIN-MS delivery confirmed).
+
+    :query param since: sequence number (`seq`) of the last event
+      seen, to resume from.  The Last-Event-ID header, sent by a
+      reconnecting EventSource, is used in its absence.
+    :query param report_type: optionally limit events to report_type
+    :query param reportable_region: optionally limit events to region
+    :query param timeout: maximum seconds to wait for events, default 30
+    :query param limit: maximum events returned by a long poll
+
+    Clients accepting 'text/event-stream' receive Server-Sent Events
+    until the timeout.  Otherwise, a list of events is returned as
+    soon as any are available, or an empty list on timeout.
+
+    Consumers beyond `changes.max_consumers` are refused with 503.
+
+    """
+    since = request.params.get('since') or\
+        request.headers.get('Last-Event-ID')
+    try:
+        criteria = event_criteria(
+            since, report_type=request.params.get('report_type'),
+            reportable_region=request.params.get('reportable_region'))
+    except ValueError:
+        raise HTTPBadRequest("Invalid event sequence number '%s'" % since)
+    timeout = min(int(request.params.get('timeout', 30)), 300)
+
+    consumers = request.registry.settings.get('change_consumers')
+    if consumers is not None and not consumers.acquire():
+        raise Overloaded("Too many change feed consumers, retry later",
+                         int(request.registry.settings.get(
+                             'changes.retry_after', 10)))
+    release = consumers.release if consumers is not None else None
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        # the slot is held until the server closes the stream
+        app_iter = server_sent_events(request.db, criteria, timeout)
+        if release is not None:
+            app_iter = ReleasingIterable(app_iter, release)
+        return Response(app_iter=app_iter,
+                        content_type='text/event-stream',
+                        cache_control='no-cache')
+
+    try:
+        limit = int(request.params.get('limit', 100))
+        events = []
+        for event in tail_events(request.db, criteria, timeout):
+            if event is None:
+                if events:
+                    break
+                continue
+            events.append(event)
+            if len(events) >= limit:
+                break
+        return events
+    finally:
+        if release is not None:
+            release()
+
+
+@view_config(context=MemoryReport, request_method='GET', renderer='json')
+def worst_memory(context, request):
+    """List the recent requests which grew memory the most
+
+    :query param limit: number of requests listed, default 20
+
+    Each entry names the request's path, context and view, the
+    document handled (if any) and the memory growth in bytes.
+    Requires `memory.profile` to be enabled.
+
+    """
+    return context.worst(int(request.params.get('limit', 20)))
+
+
+@view_config(context=Metrics, request_method='GET', renderer='json')
+def show_metrics(context, request):
+    """Request counts and cache sizes, totalled over every worker
+
+    Lists each worker's own metrics too.  Requires `metrics.interval`
+    to be set.
+
+    """
+    return context.aggregate()
+
+
+@view_config(context=Retention, request_method='GET', renderer='json')
+def retention_dry_run(context, request):
+    """Report documents the retention rules would currently expire
+
+    Nothing is deleted, each configured rule is listed with its cutoff
+    date and the count of documents older than the cutoff.
+
+    """
+    return context.dry_run()
+
+
 # Named @@delete view for browsers which can't send method=DELETE
 @view_config(context=BaseReport, request_method='DELETE',
              renderer='pheme.webAPI:templates/deleted.pt')
@@ -128,10 +476,20 @@ def upload_report(context, request):
     include the following, take action:
 
     :query param compress_with: Can be 'gzip' or 'zip' (or None)
-      to invoke compression before persisting.
+      to invoke compression before persisting.  Defaults to the
+      compression configured for the report type.
 
     :query param allow_duplicate_filename: Set true to override
-      default of not allowing duplicate filename inserts.
+      default of not allowing duplicate filename inserts.  Each
+      upload of a filename is stored as a new version, flagged as the
+      latest.
+
+    Report types configured in `delta.report_types` are stored as a
+    delta against the previous version, when uncompressed.
+
+    The uncompressed length, record count and sha256 of the content
+    are derived while it's stored, along with the header row of CSV
+    style report types, and kept in the document's metadata.
 
     :query param metadata: Optional dictionary defining additional
       metadata to store with the document.  It is suggested to include
@@ -151,32 +509,24 @@ def upload_report(context, request):
                             'zip': 'application/zip'}
         return content_type_map[compression]
 
-    compression = request.params.get('compress_with', None)
+    report_type = report_types.get(context.report_type)
+    bucket = context.bucket
+    compression = request.params.get(
+        'compress_with', report_type.compression if report_type else None)
     content_type = content_type_lookup(compression)
 
+    # Derive metadata from the uncompressed content as it's consumed
+    described = report_types.lookup(context.report_type)
+    derived = DerivedMetadataReader(context.file, header=bool(
+        described and described.header))
+
     if compression:
         zipfile = zip_file(request.params[context.filename].filename,
-                           request.params[context.filename].file,
-                           compression)
+                           derived, compression)
         context.filename = os.path.basename(zipfile)
         context.file = open(zipfile, 'rb')
-
-    allow_duplicate = request.params.get('allow_duplicate_filename', None)
-    if not allow_duplicate:
-        # Confirm a matching report wasn't already created.
-        criteria = {'filename': context.filename,
-                    'report_type': context.report_type}
-        metadata = json.loads(request.params.get('metadata', "{}"))
-        for k in 'reportable_region', 'patient_class',\
-                'include_updates':
-            if k in metadata:
-                criteria[k] = metadata[k]
-        match = request.document_store.find_one(criteria)
-        if match:
-            err = "duplicate filename '%s' exists for '%s'" %\
-                (context.filename, context.report_type)
-            logging.error(err)
-            raise HTTPBadRequest(err)
+    else:
+        context.file = derived
 
     # gridfs automatically includes uploadDate of utcnow()
     # content_type is the Mime-type
@@ -191,8 +541,48 @@ def upload_report(context, request):
     for k, v in json.loads(request.params.get('metadata', '{}')).items():
         kwargs[k] = v
 
-    oid = request.fs.put(context.file, **kwargs)
+    if report_type and report_type.chunk_size:
+        kwargs['chunkSize'] = report_type.chunk_size
+
+    allow_duplicate = request.params.get('allow_duplicate_filename', None)
+    if not allow_duplicate:
+        # Confirm a matching report wasn't already created.
+        criteria = report_identity(context.report_type, context.filename,
+                                   kwargs, partial=True)
+        match = bucket.files.find_one(criteria)
+        if match:
+            err = "duplicate filename '%s' exists for '%s'" %\
+                (context.filename, context.report_type)
+            logging.error(err)
+            raise HTTPBadRequest(err)
+
+    # Each upload of a report is a new version, and the latest.  The
+    # report is identified by its filename and identity fields, see
+    # report_identity
+    identity = report_identity(context.report_type, context.filename,
+                               kwargs)
+    previous = find_latest(bucket.files, identity)
+    kwargs['version'] = next_version(request.db, identity)
+    kwargs['latest'] = True
+
+    settings = request.registry.settings
+    if not compression and context.report_type in\
+            aslist(settings.get('delta.report_types', '')):
+        # Store as a delta against the previous version's snapshot
+        oid = delta.put(bucket.fs, context.file, previous,
+                        int(settings.get('delta.snapshot_interval', 10)),
+                        float(settings.get('delta.max_ratio', 0.5)),
+                        int(settings.get('delta.max_index_lines',
+                                         delta.MAX_INDEX_LINES)),
+                        **kwargs)
+    else:
+        oid = bucket.fs.put(context.file, **kwargs)
     context.file.close()
+    bucket.files.update({'_id': oid}, {'$set': derived.metadata()})
+    tag_document(request, {'_id': oid}, derived.length)
+    mark_latest(bucket.files, oid, identity, kwargs['version'])
+    record_event(request.db, 'upload', [dict(kwargs, _id=oid)])
+    invalidate_searches(request)
     logging.info("New report uploaded: http://localhost:6543/%s/%s",
                  context.report_type, oid)
     return {'document_id': str(oid)}
@@ -210,7 +600,15 @@ def transfer_report(context, request):
       orignially persisted in a compressed state, a second compression
       request will be effectively ignored
 
+    :query param skip_if_sent: Set true to skip the transfer should
+      this agent have previously transferred the document
+
     """
+    if asbool(request.params.get('skip_if_sent')) and context.already_sent():
+        logging.info("skip transfer of %s, already sent",
+                     context.document['filename'])
+        return {'doc_id': context.document_id, 'skipped': True}
+
     # Delegate to transfer agent (i.e. context, determined during traversal)
     logging.info("initiate transfer of %s", context.document['filename'])
     context.transfer_file(request.params.get('compress_with'))
@@ -14,7 +14,7 @@ requires = [
     'pyramid',
     'pyramid_debugtoolbar',
     'requests',
-    'waitress',
+    'waitress>=1.0',
     ]
 
 setup(name='pheme.webAPI',
@@ -37,10 +37,14 @@ setup(name='pheme.webAPI',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={'inotify': ['pyinotify']},
       tests_require=requires,
       test_suite="pheme.webAPI",
       entry_points="""\
       [paste.app_factory]
       main = pheme.webAPI:main
+      [console_scripts]
+      pheme_archive = pheme.webAPI.archive:main
+      pheme_serve = pheme.webAPI.serve:main
       """,
       )